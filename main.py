@@ -1,5 +1,6 @@
 from loguru import logger
 import discord
+import signal
 
 import src.env as env
 from src.dbot.commands import setup_commands
@@ -10,6 +11,8 @@ if __name__ == "__main__":
     logger.add("log/file_{time}.log", rotation="1 week", enqueue=True)
     setup_commands(tree)
     bot_setup(bot, tree)
+    # A deploy stops the bot with SIGTERM; handled like Ctrl+C so that bot.close runs
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     try:
         logger.info("Starting bot...")
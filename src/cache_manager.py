@@ -0,0 +1,140 @@
+from loguru import logger
+import os
+import time
+from typing import Optional
+
+from src.compact_schedule import CompactSchedule
+
+SIDECARS = (".compact", ".meta")
+TEMP_MAX_AGE = 3600 # seconds before a leftover temp file is treated as abandoned
+
+
+class CacheManager:
+    # Keeps an index of the schedules cached on disk, keyed by the path of their json file.
+    # The directory is walked once; after that the index follows save_json and eviction.
+    def __init__(self, base_dir: str, max_bytes: int, unreferenced_grace: float):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self.unreferenced_grace = unreferenced_grace # seconds
+        self.entries: dict[str, dict] = {} # json path -> {"bytes", "end", "saved"}
+        self.size = 0
+        self.scanned = False
+        self.evictions = 0
+        self.collections = 0
+
+    def files(self, path: str) -> list[str]:
+        return [path] + [f"{path}{suffix}" for suffix in SIDECARS]
+
+    def measure(self, path: str) -> int:
+        size = 0
+        for file_path in self.files(path):
+            try:
+                size += os.stat(file_path).st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def record(self, path: str, size: int, end: Optional[float], saved: Optional[float] = None) -> None:
+        self.forget(path)
+        self.entries[path] = {"bytes": size, "end": end, "saved": saved if saved is not None else time.time()}
+        self.size += size
+
+    def forget(self, path: str) -> None:
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry["bytes"]
+
+    def evict(self, path: str) -> None:
+        self.forget(path)
+        self.evictions += 1
+
+    def scan(self) -> dict[str, dict]:
+        # Runs in a worker thread
+        found: dict[str, dict] = {}
+        now = time.time()
+        for root, _, names in os.walk(self.base_dir):
+            for name in names:
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(".tmp"):
+                    # Left behind by a write that was interrupted
+                    if now - stat.st_mtime > TEMP_MAX_AGE:
+                        remove_file(file_path)
+                    continue
+                path = next((file_path[:-len(suffix)] for suffix in SIDECARS if name.endswith(f".json{suffix}")), file_path)
+                if not path.endswith(".json"):
+                    continue
+                entry = found.setdefault(path, {"bytes": 0, "end": None, "saved": 0.0})
+                entry["bytes"] += stat.st_size
+                entry["saved"] = max(entry["saved"], stat.st_mtime)
+                if file_path.endswith(".compact"):
+                    try:
+                        with open(file_path, "rb") as f:
+                            entry["end"] = CompactSchedule.from_bytes(f.read()).end
+                    except Exception as e:
+                        logger.warning(f"Unreadable compact schedule {file_path}: {e}")
+        return found
+
+    def merge(self, found: dict[str, dict]) -> None:
+        # Schedules saved while the scan ran are already recorded with fresher values
+        for path, entry in found.items():
+            if path not in self.entries:
+                self.record(path, entry["bytes"], entry["end"], entry["saved"])
+        self.scanned = True
+        logger.info(f"Schedule cache holds {len(self.entries)} schedules ({self.size / 1024 / 1024:.1f} MB)")
+
+    def select(self, referenced: set[str], now: float) -> list[str]:
+        # Schedules no registration uses are always evicted. Over the budget, ended schedules
+        # go next, longest ended first, then the ones saved longest ago.
+        victims = [
+            path for path, entry in self.entries.items()
+            if path not in referenced and now - entry["saved"] >= self.unreferenced_grace
+        ]
+        excess = self.size - sum(self.entries[path]["bytes"] for path in victims) - self.max_bytes
+        if excess <= 0:
+            return victims
+
+        chosen = set(victims)
+        def order(path: str) -> tuple:
+            entry = self.entries[path]
+            ended = entry["end"] is not None and entry["end"] < now
+            return (not ended, entry["end"] if ended else entry["saved"])
+        for path in sorted((path for path in self.entries if path not in chosen), key=order):
+            if excess <= 0:
+                break
+            victims.append(path)
+            excess -= self.entries[path]["bytes"]
+        logger.warning(f"Schedule cache over its {self.max_bytes / 1024 / 1024:.0f} MB budget: evicting {len(victims) - len(chosen)} referenced schedules")
+        return victims
+
+    def remove(self, paths: list[str]) -> None:
+        # Runs in a worker thread
+        for path in paths:
+            for file_path in self.files(path):
+                remove_file(file_path)
+            # Empty event directories would otherwise pile up
+            directory = os.path.dirname(path)
+            if os.path.normpath(directory) != os.path.normpath(self.base_dir):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "collections": self.collections,
+        }
+
+
+def remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
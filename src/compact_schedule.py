@@ -0,0 +1,205 @@
+import bisect
+import datetime
+import json
+import struct
+import sys
+from array import array
+from functools import lru_cache
+from typing import Optional
+import pytz
+
+# File layout: MAGIC, header length, JSON header (schedule fields, item titles, the rest of each data row),
+# then the packed item start epochs ("d") and item lengths in seconds ("q").
+MAGIC = b"HDC1"
+HEADER = struct.Struct("<4sI")
+
+@lru_cache(maxsize=None)
+def get_timezone(name: str) -> datetime.tzinfo:
+    return pytz.timezone(name)
+
+def parse_epoch(value) -> Optional[float]:
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class CompactSchedule:
+    __slots__ = ("name", "url", "timezone", "start", "description", "starts", "lengths", "titles", "details")
+
+    def __init__(self, name: str, url: str, timezone: str, start: Optional[float], description: str,
+                 starts: array, lengths: array, titles: list[str], details: list[str]):
+        self.name = name
+        self.url = url
+        self.timezone = timezone
+        self.start = start
+        self.description = description
+        self.starts = starts
+        self.lengths = lengths
+        self.titles = titles
+        self.details = details
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def tz(self) -> datetime.tzinfo:
+        return get_timezone(self.timezone)
+
+    @property
+    def end(self) -> Optional[float]:
+        if not self.starts:
+            return self.start
+        return self.starts[-1] + self.lengths[-1]
+
+    def item_time(self, index: int) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.starts[index], tz=self.tz)
+
+    def item_description(self, index: int) -> str:
+        # Same text as joining the item's whole data row
+        if self.details[index]:
+            return f"{self.titles[index]}\n{self.details[index]}"
+        return self.titles[index]
+
+    # Items are sorted by start, so lookups by time are a binary search over `starts`
+    def current_index(self, now: float) -> Optional[int]:
+        index = bisect.bisect_right(self.starts, now) - 1
+        if index >= 0 and self.starts[index] < now < self.starts[index] + self.lengths[index]:
+            return index
+        return None
+
+    def next_index(self, now: float) -> Optional[int]:
+        index = bisect.bisect_right(self.starts, now)
+        return index if index < len(self.starts) else None
+
+    def upcoming(self, now: float, count: int) -> range:
+        index = bisect.bisect_right(self.starts, now)
+        return range(index, min(index + count, len(self.starts)))
+
+    def first_unfinished(self, now: float) -> int:
+        return max(bisect.bisect_right(self.starts, now) - 1, 0)
+
+    def with_ticker(self, ticker: "CompactSchedule", now: float) -> "CompactSchedule":
+        # The program the ticker reports as running, followed by the items after it in this schedule
+        current = ticker.current_index(now)
+        first = self.next_index(now)
+        first = len(self) if first is None else first
+        starts, lengths = array("d"), array("q")
+        titles, details = [], []
+        if current is not None:
+            starts.append(ticker.starts[current])
+            lengths.append(ticker.lengths[current])
+            titles.append(ticker.titles[current])
+            details.append(ticker.details[current])
+        starts.extend(self.starts[first:])
+        lengths.extend(self.lengths[first:])
+        titles.extend(self.titles[first:])
+        details.extend(self.details[first:])
+        return CompactSchedule(self.name, self.url, self.timezone, self.start, self.description, starts, lengths, titles, details)
+
+    def memory_size(self) -> int:
+        # Estimated bytes held in memory, for the cache budget
+        size = sys.getsizeof(self) + sys.getsizeof(self.starts) + sys.getsizeof(self.lengths)
+        for text in (self.name, self.url, self.timezone, self.description):
+            size += sys.getsizeof(text)
+        for texts in (self.titles, self.details):
+            size += sys.getsizeof(texts) + sum(sys.getsizeof(text) for text in texts)
+        return size
+
+    def item_key(self, index: int) -> tuple:
+        return (self.starts[index], self.lengths[index], self.titles[index], self.details[index])
+
+    @classmethod
+    def from_json(cls, json_data: dict) -> "CompactSchedule":
+        schedule = json_data["schedule"]
+        starts = array("d")
+        lengths = array("q")
+        titles = []
+        details = []
+        for item in schedule.get("items") or []:
+            # Items after the first one without a scheduled time are never used
+            scheduled_t = item.get("scheduled_t")
+            if scheduled_t is None:
+                scheduled_t = parse_epoch(item.get("scheduled"))
+            if scheduled_t is None:
+                break
+            data = item.get("data") or [""]
+            starts.append(float(scheduled_t))
+            lengths.append(int(item.get("length_t") or 0))
+            titles.append(str(data[0]))
+            details.append("\n".join([str(i) for i in data[1:]]))
+
+        start = schedule.get("start_t")
+        if start is None:
+            start = parse_epoch(schedule.get("start"))
+        return cls(
+            name=schedule.get("name", ""),
+            url=schedule.get("url", ""),
+            timezone=schedule.get("timezone") or "UTC",
+            start=float(start) if start is not None else None,
+            description=schedule.get("description") or "",
+            starts=starts,
+            lengths=lengths,
+            titles=titles,
+            details=details,
+        )
+
+    @classmethod
+    def from_ticker(cls, ticker_data: dict) -> "CompactSchedule":
+        # Horaro's ticker document: the schedule header plus its previous, current and next items
+        ticker = ticker_data["ticker"]
+        items = [ticker[slot] for slot in ("previous", "current", "next") if ticker.get(slot)]
+        return cls.from_json({"schedule": {**ticker_data["schedule"], "items": items}})
+
+    def to_bytes(self) -> bytes:
+        header = json.dumps({
+            "name": self.name,
+            "url": self.url,
+            "timezone": self.timezone,
+            "start": self.start,
+            "description": self.description,
+            "count": len(self.starts),
+            "titles": self.titles,
+            "details": self.details,
+        }, ensure_ascii=False).encode("utf-8")
+        return HEADER.pack(MAGIC, len(header)) + header + self.starts.tobytes() + self.lengths.tobytes()
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "CompactSchedule":
+        magic, header_length = HEADER.unpack_from(raw)
+        if magic != MAGIC:
+            raise ValueError("Not a compact schedule file")
+        offset = HEADER.size
+        header = json.loads(raw[offset:offset + header_length])
+        offset += header_length
+
+        count = header["count"]
+        starts = array("d")
+        starts.frombytes(raw[offset:offset + count * starts.itemsize])
+        offset += count * starts.itemsize
+        lengths = array("q")
+        lengths.frombytes(raw[offset:offset + count * lengths.itemsize])
+        if len(starts) != count or len(lengths) != count:
+            raise ValueError("Truncated compact schedule file")
+        return cls(
+            name=header["name"],
+            url=header["url"],
+            timezone=header["timezone"],
+            start=header["start"],
+            description=header["description"],
+            starts=starts,
+            lengths=lengths,
+            titles=header["titles"],
+            details=header["details"],
+        )
+
+
+def diff_items(old: Optional[CompactSchedule], new: CompactSchedule) -> tuple[list[int], list[int]]:
+    # Items are matched by start time, length and content. Returns the indexes
+    # of `old` items that are gone and of `new` items that did not exist before.
+    if old is None or old.name != new.name or old.timezone != new.timezone:
+        return list(range(len(old) if old is not None else 0)), list(range(len(new)))
+    old_keys = {old.item_key(i) for i in range(len(old))}
+    new_keys = {new.item_key(i) for i in range(len(new))}
+    removed = [i for i in range(len(old)) if old.item_key(i) not in new_keys]
+    added = [i for i in range(len(new)) if new.item_key(i) not in old_keys]
+    return removed, added
@@ -1,41 +1,73 @@
 from loguru import logger
 import discord
 from discord.ext import tasks
-import asyncio
+import time
 
 import src.env as env
 import src.dbot.notify as notify
 import src.fetch_json as fetch_json
+import src.events as events
+import src.metrics as metrics
+
+class Client(discord.Client):
+    async def close(self):
+        # Called by bot.run on SIGINT and on any other stop
+        try:
+            await super().close()
+        finally:
+            await shutdown()
+
+async def shutdown():
+    # Journal records buffered in the last PERSIST_WINDOW seconds would otherwise be lost,
+    # and a lost "sent" record means that reminder is sent again after the restart
+    await notify.journal.close()
+    await fetch_json.close_session()
+    await metrics.stop_server()
+    logger.info("Shut down cleanly")
 
 intents = discord.Intents.default()
 
-bot = discord.Client(intents=intents)
+bot = Client(intents=intents)
 tree = discord.app_commands.CommandTree(bot)
 
-initialize_fetch_jsons = False
+started_at = time.monotonic()
 
 def bot_setup(bot: discord.Client, tree: discord.app_commands.CommandTree):
     @bot.event
     async def on_ready():
         logger.info(f"Logged in as {bot.user}")
+        if env.METRICS_PORT:
+            # Metrics are optional: a busy port must not keep the bot from starting
+            try:
+                await metrics.start_server(env.METRICS_HOST, env.METRICS_PORT)
+            except OSError as e:
+                logger.error(f"Failed to serve metrics on {env.METRICS_HOST}:{env.METRICS_PORT}: {e}")
 
-        fetch_jsons.start()
-        while not initialize_fetch_jsons:
-            await asyncio.sleep(1)
-        schedule_notifications.start()
-        asyncio.create_task(notify.process_event_queue())
-        logger.info("Started tasks Successfully")
+        # The journal is replayed against the registrations, so removed events do not fire
+        await events.load_events()
+        await notify.restore_notifications()
+        notify.start_event_queue()
+        # Serve from the schedules already in CACHE_DIR; the refresh below runs in the background
+        await notify.schedule_notifications(fetch_missing=False)
+        logger.info(f"Notifications ready {time.monotonic() - started_at:.2f}s after startup")
 
         await tree.sync()
         logger.info("Synced commands Successfully")
 
-    @tasks.loop(hours=env.FETCH_JSONS_INTERVAL)
+        fetch_jsons.start()
+        schedule_notifications.start()
+        collect_cache.start()
+        logger.info("Started tasks Successfully")
+
+    @tasks.loop(minutes=env.REFRESH_CHECK_INTERVAL)
     async def fetch_jsons():
-        data = await fetch_json.fetch_jsons_from_csv(env.EVENTS)
-        await fetch_json.save_jsons(data, env.CACHE_DIR)
-        global initialize_fetch_jsons
-        initialize_fetch_jsons = True
+        await fetch_json.refresh_jsons(await events.get_schedule_urls())
 
     @tasks.loop(hours=env.SCHEDULE_NOTIFICATIONS_INTERVAL)
     async def schedule_notifications():
-        await notify.schedule_notifications()
\ No newline at end of file
+        await notify.schedule_notifications()
+
+    @tasks.loop(hours=env.CACHE_GC_INTERVAL)
+    async def collect_cache():
+        schedule_urls = await events.get_schedule_urls()
+        await fetch_json.collect_cache(list(schedule_urls.values()))
\ No newline at end of file
@@ -1,15 +1,23 @@
 from loguru import logger
+import asyncio
 import discord
 from discord.app_commands import describe
 from datetime import timedelta, datetime
-import dateutil.parser
 import pytz
+import time
+from typing import Optional
 
 import src.env as env
 import src.events as events
+import src.metrics as metrics
 import src.fetch_json as fetch_json
 import src.dbot.notify as notify
 
+CREATE_EVENT_CONCURRENCY = 5
+NOW_CACHE_MAX_TTL = 3600 # seconds
+
+_now_cache: dict[int, tuple[tuple, float, list[discord.Embed]]] = {} # guild -> (key, expires, embeds)
+
 class Confirm(discord.ui.View):
     def __init__(self, url: str):
         super().__init__()
@@ -27,6 +35,139 @@ class Confirm(discord.ui.View):
         await interaction.response.edit_message(content="Event removal cancelled.", view=None)
 
 
+async def compute_now_embeds(guild_id: int, rows: list[dict], now: float) -> tuple[list[discord.Embed], float]:
+    # The programs running now in the given registrations, and the time until which that answer holds:
+    # the next program start or end, or the moment an event enters its monitoring range
+    embeds = []
+    expires = now + NOW_CACHE_MAX_TTL
+    for info in rows:
+        schedule = await fetch_json.get_compact(info["url"])
+        if schedule is None:
+            logger.debug(f"Failed to get event data: {info['url']}")
+            continue
+
+        if len(schedule) == 0:
+            logger.debug(f"No items found in event data: {info['url']}")
+            continue
+
+        if schedule.start is None:
+            logger.debug(f"No start time found in event data: {info['url']}")
+            continue
+
+        monitor_start_time = schedule.start - info['notice'] * 2 * 60
+
+        if now < monitor_start_time:
+            logger.debug(f"Event not yet in monitoring range: {info['url']}")
+            expires = min(expires, monitor_start_time)
+            continue
+
+        logger.debug(f"Monitoring event: {info['url']} Start time: {schedule.start}")
+        # A live event is read from the ticker when Horaro has one
+        ticker = await fetch_json.get_live_ticker(info["url"], schedule)
+        if ticker:
+            expires = min(expires, now + env.TICKER_INTERVAL)
+        live = ticker or schedule
+        index = live.current_index(now)
+        if index is not None:
+            expires = min(expires, live.starts[index] + live.lengths[index])
+            embed = discord.Embed(
+                title=schedule.name,
+                color=5025616,
+                url=info["url"],
+                timestamp=live.item_time(index),
+                description=f"{live.titles[index]}"
+            )
+            logger.debug(f"{guild_id} - Found current program: {live.titles[index]}")
+            embeds.append(embed)
+        next_index = live.next_index(now)
+        if next_index is not None:
+            expires = min(expires, live.starts[next_index])
+    return embeds, expires
+
+def now_cache_key(rows: list[dict]) -> tuple:
+    # Valid while the registrations and their saved schedules stay the same
+    return (
+        frozenset((row["url"], row["notice"]) for row in rows),
+        events.generation,
+        tuple(fetch_json.get_schedule_version(row["url"]) for row in rows),
+    )
+
+async def get_now_embeds(guild_id: int) -> Optional[list[discord.Embed]]:
+    # The programs running now in every schedule registered in the guild; None when nothing is registered
+    rows = await events.get_event_rows_server(guild_id)
+    if len(rows) == 0:
+        return None
+
+    now = time.time()
+    cached = _now_cache.get(guild_id)
+    if cached is not None and cached[0] == now_cache_key(rows) and now < cached[1]:
+        return cached[2]
+
+    embeds, expires = await compute_now_embeds(guild_id, rows, now)
+    # Keyed after computing, as fetching a missing schedule saves it and changes its version
+    _now_cache[guild_id] = (now_cache_key(rows), expires, embeds)
+    return embeds
+
+
+def event_times(data: dict) -> tuple[datetime, datetime]:
+    start_time = discord.utils.parse_time(data["schedule"]["start"])
+    if len(data["schedule"]["items"]) == 0:
+        end_time = start_time + timedelta(hours=1)
+    else:
+        scheduled_t = discord.utils.parse_time(data["schedule"]["items"][-1]["scheduled"])
+        end_time = scheduled_t + timedelta(seconds=data["schedule"]["items"][-1]["length_t"])
+    return start_time, end_time
+
+async def create_scheduled_events(guild: discord.Guild, urls: list[str]) -> tuple[int, list[str]]:
+    # Creates the scheduled events of every schedule concurrently. Returns the number
+    # created and one line for each schedule that was skipped or failed.
+    schedules = fetch_json.unique_urls(urls)
+    datas = await asyncio.gather(*(fetch_json.get_json(url) for url in schedules))
+    existing_events = {existing_event.name: existing_event for existing_event in await guild.fetch_scheduled_events()}
+    # discord.py waits out rate limits per route by itself; this only bounds how many requests queue up
+    semaphore = asyncio.Semaphore(CREATE_EVENT_CONCURRENCY)
+    claimed: set[str] = set()
+
+    async def create(url: str, data: Optional[dict]) -> Optional[str]:
+        if data is None:
+            return f"Failed to get the event data: {url}"
+        name = data["schedule"]["name"]
+        try:
+            start_time, end_time = event_times(data)
+            now = datetime.now(tz=pytz.timezone(data["schedule"]["timezone"]))
+        except (KeyError, ValueError, TypeError, pytz.UnknownTimeZoneError) as e:
+            logger.error(f"Invalid schedule data for {url}: {e}")
+            return f"Failed to read the event data: {url}"
+        if start_time <= now or end_time <= now:
+            logger.debug(f"{guild.id} - Cannot schedule event in the past: {name}")
+            return f"Cannot schedule event in the past: {name}"
+        if name in existing_events or name in claimed:
+            logger.debug(f"{guild.id} - Scheduled event with the name '{name}' already exists")
+            return f"Scheduled event with the name '{name}' already exists."
+        claimed.add(name)
+
+        async with semaphore:
+            try:
+                scheduled_event = await guild.create_scheduled_event(
+                    name=name,
+                    description=data["schedule"]["description"],
+                    start_time=start_time,
+                    end_time=end_time,
+                    entity_type=discord.EntityType.external,
+                    privacy_level=discord.PrivacyLevel.guild_only,
+                    location=url,
+                )
+            except discord.HTTPException as e:
+                logger.error(f"Failed to create scheduled event: {e}")
+                return f"Failed to create scheduled event '{name}': {e}"
+        logger.debug(f"{guild.id} - Created scheduled event: {scheduled_event.name}")
+        return None
+
+    outcomes = await asyncio.gather(*(create(url, data) for url, data in zip(schedules, datas)))
+    problems = [outcome for outcome in outcomes if outcome is not None]
+    return len(outcomes) - len(problems), problems
+
+
 def setup_commands(tree: discord.app_commands.CommandTree):
     logger.info("Setting up commands...")
 
@@ -34,6 +175,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
         name="update_schedule",
         description="Update the Horaro schedule data",
     )
+    @metrics.timed("discord_command_seconds", command="update_schedule")
     async def update_schedule(interaction: discord.Interaction):
         await interaction.response.defer()
         message = await interaction.followup.send("Updating schedule...", wait=True)
@@ -41,9 +183,8 @@ def setup_commands(tree: discord.app_commands.CommandTree):
 
         guild_id = interaction.guild_id if interaction.guild_id is not None else -1 # If the interaction is not in a guild, set the guild_id to -1
         server_events = await events.get_events_server(guild_id)
-        data = await fetch_json.fetch_jsons(server_events["url"].tolist())
-        await fetch_json.save_jsons(data, env.CACHE_DIR)
-        await notify.schedule_notifications()
+        # Changed schedules are rescheduled as they are saved
+        await fetch_json.update_jsons(server_events["url"].tolist())
 
         logger.debug(f"{interaction.guild_id} - Updated schedule data")
         await message.edit(content="Updated the schedule data successfully!")
@@ -56,6 +197,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
         url="URL of the event",
         notice="How many minutes before to send the notification"
     )
+    @metrics.timed("discord_command_seconds", command="add_event")
     async def add_event(interaction: discord.Interaction, url: str, notice: int = 10):
         await interaction.response.defer()
         message = await interaction.followup.send("Adding event...", wait=True)
@@ -69,17 +211,19 @@ def setup_commands(tree: discord.app_commands.CommandTree):
             await message.edit(content="Event already exists.")
             return
 
+        # Asked for explicitly, so a 404 remembered from an earlier attempt is not trusted
+        fetch_json.forget_not_found(url)
         data = await fetch_json.fetch_json(url)
         if data:
             await fetch_json.save_json(data, env.CACHE_DIR)
             await events.add_event(url, notice, guild_id, channel_id)
-            await notify.schedule_notifications()
+            await notify.schedule_registration({"url": url, "notice": notice, "server": guild_id, "channel": channel_id})
 
             embed = discord.Embed(
                 title=data["schedule"]["name"],
                 color=5872610,
                 url=url,
-                timestamp=dateutil.parser.parse(data["schedule"]["start"]),
+                timestamp=datetime.fromisoformat(data["schedule"]["start"]),
                 description=f"{data['schedule']['description']}"
                 )
 
@@ -96,6 +240,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
     @describe(
         url="URL of the event",
     )
+    @metrics.timed("discord_command_seconds", command="remove_event")
     async def remove_event(interaction: discord.Interaction, url: str):
         logger.debug(f"{interaction.guild_id} - remove_event")
         view = Confirm(url)
@@ -105,6 +250,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
         name="list_events",
         description="List all events",
     )
+    @metrics.timed("discord_command_seconds", command="list_events")
     async def list_events(interaction: discord.Interaction):
         await interaction.response.defer()
         message = await interaction.followup.send("Listing events...", wait=True)
@@ -141,6 +287,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
         url="URL of the event",
         notice="New notice time in minutes"
     )
+    @metrics.timed("discord_command_seconds", command="change_notice")
     async def change_notice(interaction: discord.Interaction, url: str, notice: int):
         await interaction.response.defer()
         message = await interaction.followup.send("Changing notice time...", wait=True)
@@ -158,6 +305,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
         url="URL of the event",
         channel="New channel ID"
     )
+    @metrics.timed("discord_command_seconds", command="change_channel")
     async def change_channel(interaction: discord.Interaction, url: str, channel: int):
         await interaction.response.defer()
         message = await interaction.followup.send("Changing channel...", wait=True)
@@ -175,6 +323,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
         old_url="Old URL of the event",
         new_url="New URL of the event"
     )
+    @metrics.timed("discord_command_seconds", command="change_url")
     async def change_url(interaction: discord.Interaction, old_url: str, new_url: str):
         await interaction.response.defer()
         message = await interaction.followup.send("Changing URL...", wait=True)
@@ -191,6 +340,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
     @describe(
         url="URL of the event",
     )
+    @metrics.timed("discord_command_seconds", command="create_server_event")
     async def create_server_event(interaction: discord.Interaction, url: str, description: str=""):
         await interaction.response.defer()
         message = await interaction.followup.send("Creating event...", wait=True)
@@ -214,12 +364,7 @@ def setup_commands(tree: discord.app_commands.CommandTree):
             await message.edit(content="Failed to get the event data. Please check the URL and try again.")
             return
 
-        start_time = discord.utils.parse_time(data["schedule"]["start"])
-        if len(data["schedule"]["items"]) == 0:
-            end_time = start_time + timedelta(hours=1)
-        else:
-            scheduled_t = discord.utils.parse_time(data["schedule"]["items"][-1]["scheduled"])
-            end_time = scheduled_t + timedelta(seconds=data["schedule"]["items"][-1]["length_t"])
+        start_time, end_time = event_times(data)
 
         timezone = pytz.timezone(data["schedule"]["timezone"])
         now = datetime.now(tz=timezone)
@@ -228,11 +373,10 @@ def setup_commands(tree: discord.app_commands.CommandTree):
             await message.edit(content="Cannot schedule event in the past. Please check the event times.")
             return
 
-        existing_events = await interaction.guild.fetch_scheduled_events() # type: ignore
-        for existing_event in existing_events:
-            if existing_event.name == data["schedule"]["name"]:
-                await message.edit(content=f"Scheduled event with the name '{existing_event.name}' already exists.")
-                return
+        existing_names = {existing_event.name for existing_event in await interaction.guild.fetch_scheduled_events()} # type: ignore
+        if data["schedule"]["name"] in existing_names:
+            await message.edit(content=f"Scheduled event with the name '{data['schedule']['name']}' already exists.")
+            return
 
         try:
             scheduled_event = await interaction.guild.create_scheduled_event( # type: ignore
@@ -254,13 +398,12 @@ def setup_commands(tree: discord.app_commands.CommandTree):
         name="create_server_event_all",
         description="Create all server events from the schedule",
     )
+    @metrics.timed("discord_command_seconds", command="create_server_event_all")
     async def create_server_event_all(interaction: discord.Interaction):
         await interaction.response.defer()
         message = await interaction.followup.send("Creating all events...", wait=True)
         logger.debug(f"{interaction.guild_id} - create_server_event_all")
 
-        created_events = 0
-
         guild_id = interaction.guild_id if interaction.guild_id is not None else -1
 
         if guild_id == -1:
@@ -273,129 +416,37 @@ def setup_commands(tree: discord.app_commands.CommandTree):
             await message.edit(content="No events found in this server. Please add events first.")
             return
 
-        data = await fetch_json.get_jsons(server_events["url"].tolist())
-        if data is None:
-            logger.error(f"{interaction.guild_id} - Failed to get event data")
-            await message.edit(content="Failed to get the event data. Please check the URL and try again.")
-            return
-
-        existing_events = await interaction.guild.fetch_scheduled_events() # type: ignore
-        for event, server_event in zip(data, server_events.to_dict(orient="records")):
-            try:
-                start_time = discord.utils.parse_time(event["schedule"]["start"])
-                if len(event["schedule"]["items"]) == 0:
-                    end_time = start_time + timedelta(hours=1)
-                else:
-                    scheduled_t = discord.utils.parse_time(event["schedule"]["items"][-1]["scheduled"])
-                    end_time = scheduled_t + timedelta(seconds=event["schedule"]["items"][-1]["length_t"])
-
-                timezone = pytz.timezone(event["schedule"]["timezone"])
-                now = datetime.now(tz=timezone)
-
-                if start_time <= now or end_time <= now:
-                    logger.debug(f"{interaction.guild_id} - Cannot schedule event in the past. Please check the event times.")
-                    message = await message.edit(content=f"{message.content}\nCannot schedule event in the past. Please check the event times.")
-                    continue
-
-                event_exists = False
-                for existing_event in existing_events:
-                    if existing_event.name == event["schedule"]["name"]:
-                        logger.debug(f"{interaction.guild_id} - Scheduled event with the name '{existing_event.name}' already exists")
-                        message = await message.edit(content=f"{message.content}\nScheduled event with the name '{existing_event.name}' already exists.")
-                        event_exists = True
-                        break
-                if event_exists:
-                    continue
-
-                scheduled_event = await interaction.guild.create_scheduled_event( # type: ignore
-                    name=event["schedule"]["name"],
-                    description=event["schedule"]["description"],
-                    start_time=start_time,
-                    end_time=end_time,
-                    entity_type=discord.EntityType.external,
-                    privacy_level=discord.PrivacyLevel.guild_only,
-                    location=server_event["url"],
-                )
-                created_events += 1
-                logger.debug(f"{interaction.guild_id} - Created scheduled event: {scheduled_event.name}")
-            except Exception as e:
-                logger.error(f"Failed to create scheduled event: {e}")
-                message = await message.edit(content=f"{message.content}\nFailed to create scheduled event: {e}")
-                continue
+        created_events, problems = await create_scheduled_events(interaction.guild, server_events["url"].tolist()) # type: ignore
 
+        # One edit with every outcome, instead of one per skipped or failed schedule
         if created_events == 0:
             logger.debug(f"{interaction.guild_id} - No events created")
-            await message.edit(content="No events created.")
-        else:
+            summary = "No events created."
+        elif not problems:
             logger.debug(f"{interaction.guild_id} - All scheduled events({created_events}) created successfully")
-            await message.edit(content=f"All scheduled events({created_events}) created successfully!")
+            summary = f"All scheduled events({created_events}) created successfully!"
+        else:
+            logger.debug(f"{interaction.guild_id} - Scheduled events({created_events}) created, {len(problems)} skipped")
+            summary = f"Scheduled events({created_events}) created successfully."
+        await message.edit(content="\n".join([summary, *problems])[:2000])
 
     @tree.command(
         name="get_now_program",
         description="Get the current program",
     )
+    @metrics.timed("discord_command_seconds", command="get_now_program")
     async def get_now_program(interaction: discord.Interaction):
         await interaction.response.defer()
         message = await interaction.followup.send("Getting the current program...", wait=True)
         logger.debug(f"{interaction.guild_id} - get_now_program")
 
         guild_id = interaction.guild_id if interaction.guild_id is not None else -1
-        server_events = await events.get_events_server(guild_id)
-
-        embeds = []
+        embeds = await get_now_embeds(guild_id)
 
-        if len(server_events) == 0:
+        if embeds is None:
             logger.debug(f"{interaction.guild_id} - No events found in this server")
             return
 
-        for _, info in server_events.iterrows():
-            event_data = await fetch_json.get_json(info["url"])
-            if event_data is None:
-                logger.debug(f"Failed to get event data: {info['url']}")
-                continue
-
-            items = event_data["schedule"]["items"]
-            if not items:
-                logger.debug(f"No items found in event data: {info['url']}")
-                continue
-
-            event_start_time_str = event_data["schedule"]["start"]
-            if not event_start_time_str:
-                logger.debug(f"No start time found in event data: {info['url']}")
-                continue
-
-            event_start_time = dateutil.parser.parse(event_start_time_str)
-            monitor_start_time = event_start_time - timedelta(minutes=info['notice'] * 2)
-            timezone = pytz.timezone(event_data["schedule"]["timezone"])
-            now = datetime.now(timezone)
-
-            if now < monitor_start_time:
-                logger.debug(f"Event not yet in monitoring range: {info['url']}")
-                continue
-
-            logger.debug(f"Monitoring event: {info['url']} Start time: {event_start_time}")
-            for item in items:
-                scheduled_str = item.get("scheduled", None)
-                if not scheduled_str:
-                    logger.debug(f"No scheduled time found in item: {item['data'][0]}")
-                    break
-                else:
-                    pass
-                scheduled_time = dateutil.parser.parse(scheduled_str)
-
-                if scheduled_time < now < scheduled_time + timedelta(seconds=item["length_t"]):
-                    embed = discord.Embed(
-                        title=event_data["schedule"]["name"],
-                        color=5025616,
-                        url=info["url"],
-                        timestamp=scheduled_time,
-                        description=f"{item['data'][0]}"
-                    )
-                    logger.debug(f"{interaction.guild_id} - Found current program: {item['data'][0]}")
-                    embeds.append(embed)
-                    continue
-                else:
-                    pass
         if embeds == []:
             await message.edit(content="No current program found.")
         else:
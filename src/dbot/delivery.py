@@ -0,0 +1,68 @@
+from loguru import logger
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+from src.rate_limit import TokenBucket
+
+MAX_EMBEDS = 10 # Discord's limit per message
+MAX_EMBED_LENGTH = 6000 # Discord's limit in characters for all embeds of a message together
+
+
+class ChannelDelivery:
+    def __init__(self, send: Callable[[list[Any]], Awaitable[None]], length: Callable[[Any], int], window: float, rate: float, burst: float):
+        self.send = send
+        self.length = length # characters the notification's embed counts toward MAX_EMBED_LENGTH
+        self.window = window # seconds to wait for more notifications to the same channel
+        self.rate = rate
+        self.burst = burst
+        self.buffers: dict[Hashable, list[Any]] = {}
+        self.flushers: dict[Hashable, asyncio.Task] = {}
+        self.buckets: dict[Hashable, TokenBucket] = {}
+        self.sent = 0
+        self.merged = 0
+        self.throttled = 0
+
+    def __len__(self) -> int:
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def enqueue(self, channel: Hashable, notification: Any) -> None:
+        self.buffers.setdefault(channel, []).append(notification)
+        if channel not in self.flushers:
+            self.flushers[channel] = asyncio.ensure_future(self._flush(channel))
+
+    async def _flush(self, channel: Hashable) -> None:
+        try:
+            await asyncio.sleep(self.window)
+            bucket = self.buckets.get(channel)
+            if bucket is None:
+                bucket = self.buckets[channel] = TokenBucket(self.rate, self.burst)
+            buffer = self.buffers[channel]
+            while buffer:
+                batch = self._take_batch(buffer)
+                if await bucket.acquire() > 0:
+                    self.throttled += 1
+                self.sent += 1
+                self.merged += len(batch) - 1
+                try:
+                    await self.send(batch)
+                except Exception as e:
+                    logger.exception(f"Failed to deliver {len(batch)} notifications to {channel}: {e}")
+        finally:
+            self.buffers.pop(channel, None)
+            self.flushers.pop(channel, None)
+
+    def _take_batch(self, buffer: list[Any]) -> list[Any]:
+        # As many notifications as one message can carry; a single one always goes out
+        count = 0
+        total = 0
+        for notification in buffer[:MAX_EMBEDS]:
+            total += self.length(notification)
+            if count and total > MAX_EMBED_LENGTH:
+                break
+            count += 1
+        batch = buffer[:count]
+        del buffer[:count]
+        return batch
+
+    def stats(self) -> dict:
+        return {"pending": len(self), "sent": self.sent, "merged": self.merged, "throttled": self.throttled}
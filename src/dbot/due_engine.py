@@ -0,0 +1,58 @@
+import bisect
+from typing import Optional
+
+from src.compact_schedule import CompactSchedule
+
+
+def compute_due(schedules: list[Optional[CompactSchedule]], schedule_ids: list[int], notices: list[int], now: float, window: float):
+    # Returns (registration indexes, item indexes, started flags) of every item that should be
+    # notified, for all registrations at once. Registration r follows schedules[schedule_ids[r]]
+    # with a notice of notices[r] minutes. Rows come out in registration order, then item order.
+    import numpy as np
+
+    if not schedule_ids:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=bool)
+
+    # Per schedule: the slice of items that can matter in this pass, found by binary search
+    count = len(schedules)
+    lows = np.zeros(count, dtype=np.int64)
+    highs = np.zeros(count, dtype=np.int64)
+    firsts = np.full(count, np.nan)
+    bases = np.zeros(count, dtype=np.int64)
+    starts = []
+    lengths = []
+    offset = 0
+    for i, schedule in enumerate(schedules):
+        bases[i] = offset
+        if schedule is None or len(schedule) == 0 or schedule.start is None:
+            continue
+        lows[i] = schedule.first_unfinished(now)
+        highs[i] = bisect.bisect_right(schedule.starts, now + window)
+        firsts[i] = schedule.start
+        starts.append(np.frombuffer(schedule.starts, dtype=np.float64))
+        lengths.append(np.frombuffer(schedule.lengths, dtype=np.int64))
+        offset += len(schedule)
+    if not starts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=bool)
+    item_starts = np.concatenate(starts)
+    item_ends = item_starts + np.concatenate(lengths)
+
+    # Per registration: which schedules are in the monitoring range for its notice
+    sids = np.asarray(schedule_ids, dtype=np.int64)
+    notice = np.asarray(notices, dtype=np.float64) * 60
+    first = firsts[sids]
+    with np.errstate(invalid="ignore"):
+        in_range = ~np.isnan(first) & (now >= first - notice - window)
+    counts = np.where(in_range, highs[sids] - lows[sids], 0).clip(min=0)
+
+    # Expand to one row per (registration, candidate item)
+    registrations = np.repeat(np.arange(len(sids)), counts)
+    row_offsets = np.cumsum(counts) - counts
+    items = lows[sids][registrations] + (np.arange(int(counts.sum())) - row_offsets[registrations])
+    positions = bases[sids][registrations] + items
+
+    started = item_starts[positions] < now
+    keep = ~started | (item_ends[positions] > now)
+    return registrations[keep], items[keep], started[keep]
@@ -0,0 +1,140 @@
+from loguru import logger
+import asyncio
+import json
+import os
+import time
+from typing import Callable, Optional
+
+from src.persistence import atomic_write
+
+# One JSON record per line:
+#   {"op": "queue", "key": [path, server, channel, event_time], "due": ..., "expires": ..., "payload": {...}}
+#   {"op": "sent", "key": [...], "expires": ...}
+#   {"op": "cancel", "key": [...]}
+
+
+class NotificationJournal:
+    # Records are buffered and appended in batches from a worker thread, at most `window`
+    # seconds after they were made. Batches and compactions are written one at a time.
+    def __init__(self, path: str, compact_threshold: int, window: float = 0.0):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.window = window # seconds
+        self.records = 0
+        self.writes = 0
+        self._buffer: list[dict] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._compaction: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def _append(self, record: dict) -> None:
+        self._buffer.append(record)
+        self.records += 1
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        # Records made from here on start the next batch
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, self._write_records, batch)
+            except OSError as e:
+                logger.error(f"Failed to write {len(batch)} records to {self.path}: {e}")
+                return
+            self.writes += 1
+
+    def _write_records(self, records: list[dict]) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+
+    def record_queued(self, key: tuple, due: float, expires: float, payload: dict) -> None:
+        self._append({"op": "queue", "key": list(key), "due": due, "expires": expires, "payload": payload})
+
+    def record_sent(self, key: tuple, expires: float) -> None:
+        self._append({"op": "sent", "key": list(key), "expires": expires})
+
+    def record_cancelled(self, key: tuple) -> None:
+        self._append({"op": "cancel", "key": list(key)})
+
+    def replay(self, now: Optional[float] = None) -> tuple[dict, dict]:
+        # Returns (pending, sent): pending maps key -> queue record, sent maps key -> expiry
+        now = time.time() if now is None else now
+        pending: dict[tuple, dict] = {}
+        sent: dict[tuple, float] = {}
+        if not os.path.exists(self.path):
+            return pending, sent
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash can leave a partial last line
+                    logger.warning(f"Skipping broken journal line {line_number} in {self.path}")
+                    continue
+                self.records += 1
+                key = tuple(record["key"])
+                if record["op"] == "queue":
+                    pending[key] = record
+                    sent.pop(key, None)
+                elif record["op"] == "sent":
+                    pending.pop(key, None)
+                    sent[key] = record["expires"]
+                elif record["op"] == "cancel":
+                    pending.pop(key, None)
+                    sent.pop(key, None)
+
+        pending = {key: record for key, record in pending.items() if record["expires"] > now}
+        sent = {key: expires for key, expires in sent.items() if expires > now}
+        return pending, sent
+
+    async def replay_async(self) -> tuple[dict, dict]:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.replay)
+
+    def needs_compaction(self, live: int) -> bool:
+        return self.records > max(self.compact_threshold, 2 * live)
+
+    async def compact(self, snapshot: Callable[[], tuple[list[tuple[tuple, float, float, dict]], list[tuple[tuple, float]]]]) -> None:
+        # Rewrites the journal with only the live state, replacing the old file atomically.
+        # `snapshot` returns (pending, sent); it runs under the write lock, so the state it
+        # returns covers every record still buffered, and those are dropped.
+        async with self._lock:
+            pending, sent = snapshot()
+            self._buffer = []
+            self.records = len(sent) + len(pending)
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, lambda: atomic_write(self.path, encode_records(pending, sent)))
+            self.writes += 1
+        logger.debug(f"Compacted notification journal: {len(pending)} pending, {len(sent)} sent")
+
+    def compact_later(self, snapshot) -> None:
+        # Compacts in the background; a compaction already running is not started again
+        if self._compaction is None or self._compaction.done():
+            self._compaction = asyncio.ensure_future(self.compact(snapshot))
+
+    async def close(self) -> None:
+        # Writes what is still buffered right away, for shutdown. A batch or compaction already
+        # being written finishes first; the pending _flush_later then finds nothing left to write.
+        await self.flush()
+
+
+def encode_records(pending: list[tuple[tuple, float, float, dict]], sent: list[tuple[tuple, float]]) -> bytes:
+    lines = [json.dumps({"op": "sent", "key": list(key), "expires": expires}, ensure_ascii=False) + "\n" for key, expires in sent]
+    lines += [
+        json.dumps({"op": "queue", "key": list(key), "due": due, "expires": expires, "payload": payload}, ensure_ascii=False) + "\n"
+        for key, due, expires, payload in pending
+    ]
+    return "".join(lines).encode("utf-8")
@@ -0,0 +1,42 @@
+import heapq
+import time
+from typing import Hashable, Optional
+
+
+class NotificationIndex:
+    def __init__(self):
+        self.expires: dict[Hashable, float] = {}
+        self.heap: list[tuple[float, Hashable]] = []
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.expires)
+
+    def __contains__(self, key: Hashable) -> bool:
+        self.expire()
+        return key in self.expires
+
+    def add(self, key: Hashable, expires_at: float) -> None:
+        self.expires[key] = expires_at
+        heapq.heappush(self.heap, (expires_at, key))
+
+    def discard(self, key: Hashable) -> None:
+        # The heap entry is skipped when it comes up for expiry
+        self.expires.pop(key, None)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        expired = 0
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self.heap)
+            if self.expires.get(key) == expires_at:
+                del self.expires[key]
+                expired += 1
+        self.evictions += expired
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.expires):
+            self.heap = [(expires_at, key) for key, expires_at in self.expires.items()]
+            heapq.heapify(self.heap)
+        return expired
+
+    def stats(self) -> dict:
+        return {"size": len(self.expires), "evictions": self.evictions}
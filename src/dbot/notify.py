@@ -1,20 +1,31 @@
 from loguru import logger
-import discord
-import asyncio
 import datetime
-import heapq
-import pytz
+import discord
+import functools
+import time
+from typing import Optional
 
 import src.env as env
 import src.dbot.bot as bot
 import src.events as events
 import src.fetch_json as fetch_json
+import src.metrics as metrics
+from src.compact_schedule import CompactSchedule, diff_items
+from src.dbot.scheduler import NotificationScheduler
+from src.dbot.notification_index import NotificationIndex
+from src.dbot.journal import NotificationJournal
+from src.dbot.delivery import ChannelDelivery
+import src.dbot.due_engine as due_engine
 
 
-event_queue = []
-sent_notifications = set()
+EMBED_TITLE = "Program detail"
+MAX_DESCRIPTION = 4096 # Discord's limit in characters for an embed description
 
-async def send_notification(server_id: int, channel_id: int, message: str, embed: discord.Embed):
+sent_notifications = NotificationIndex()
+first_notification_sent = False
+journal = NotificationJournal(env.NOTIFY_JOURNAL, env.NOTIFY_JOURNAL_COMPACT, env.PERSIST_WINDOW)
+
+async def send_notification(server_id: int, channel_id: int, message: str, embeds: list[discord.Embed]):
     guild = bot.bot.get_guild(server_id)
     if guild is None:
         logger.error(f"Guild not found: {server_id}")
@@ -26,160 +37,300 @@ async def send_notification(server_id: int, channel_id: int, message: str, embed
         return
 
     if isinstance(channel, (discord.TextChannel, discord.VoiceChannel)):
-        await channel.send(message, embed=embed)
+        await channel.send(message, embeds=embeds)
     else:
         logger.error(f"Channel type not supported for sending messages: {type(channel).__name__}")
 
-async def schedule_notifications():
-    logger.debug("Scheduling notifications start...")
-    events_info = await events.get_events()
+async def send_notifications(notifications: list[dict]):
+    # One message for every notification the delivery stage merged for a channel
+    message = "\n".join(notification_info["message"] for notification_info in notifications)
+    try:
+        await send_notification(
+            notifications[0]["server"],
+            notifications[0]["channel"],
+            message[:2000],
+            [notification_embed(notification_info) for notification_info in notifications]
+        )
+    except discord.DiscordException as e:
+        logger.error(f"Failed to send {len(notifications)} notifications: {e}")
+        # Not journalled as sent, so a restart delivers them again, and taken out of the
+        # sent index so the next scheduling pass can queue them again
+        for notification_info in notifications:
+            sent_notifications.discard(notification_info["key"])
+        return
+    else:
+        global first_notification_sent
+        if not first_notification_sent:
+            first_notification_sent = True
+            logger.info(f"First notification sent {time.monotonic() - bot.started_at:.2f}s after startup")
+    now = time.time()
+    for notification_info in notifications:
+        metrics.observe("notification_lag_seconds", now - notification_info["notice_time"])
+        journal.record_sent(notification_info["key"], notification_info["expires"])
+    maybe_compact_journal()
 
-    for _, info in events_info.iterrows():
-        event_data = await fetch_json.get_json(info['url'])
-        if event_data is None:
-            logger.debug(f"Failed to get event data: {info['url']}")
-            continue
+def notification_key(path: str, info, event_time: float) -> tuple[str, int, int, float]:
+    # Per schedule: programs of two schedules starting together in one channel are separate reminders
+    return (path, int(info["server"]), int(info["channel"]), event_time)
 
-        items = event_data["schedule"]["items"]
-        if not items:
-            logger.debug(f"No items found in event data: {info['url']}")
-            continue
+def notification_embed(payload: dict) -> discord.Embed:
+    # Built only when the notification is sent; queued payloads stay plain data
+    timestamp = datetime.datetime.fromtimestamp(payload["event_time"], tz=datetime.timezone.utc)
+    return discord.Embed(title=EMBED_TITLE, url=payload["url"], color=5025616, description=payload["description"][:MAX_DESCRIPTION], timestamp=timestamp)
 
-        event_start_time_str = event_data["schedule"]["start"]
-        if not event_start_time_str:
-            logger.debug(f"No start time found in event data: {info['url']}")
-            continue
+def embed_length(payload: dict) -> int:
+    # What notification_embed's embed counts toward Discord's limit for the whole message
+    return len(EMBED_TITLE) + min(len(payload["description"]), MAX_DESCRIPTION)
+
+def queue_notification(info, path: str, schedule: CompactSchedule, index: int, message: str):
+    event_time = schedule.starts[index]
+    notice_time = event_time - int(info["notice"]) * 60
+    key = notification_key(path, info, event_time)
+    expires = event_time + schedule.lengths[index]
+    # Kept until the program ends so neither the queue nor a later pass sends it twice
+    sent_notifications.add(key, expires)
+    payload = {
+        "key": key,
+        "server": int(info["server"]),
+        "channel": int(info["channel"]),
+        "message": message,
+        "url": info["url"],
+        "notice": int(info["notice"]),
+        "description": schedule.item_description(index),
+        "event_time": event_time,
+        "notice_time": float(notice_time),
+        "expires": expires,
+    }
+    event_queue.push(float(notice_time), key, payload)
+    journal.record_queued(key, float(notice_time), expires, journal_payload(payload))
 
-        event_start_time = datetime.datetime.fromisoformat(event_start_time_str)
-        monitor_start_time = event_start_time - datetime.timedelta(minutes=info['notice'], hours=env.SCHEDULE_NOTIFICATIONS_INTERVAL)
-        timezone = pytz.timezone(event_data["schedule"]["timezone"])
-        now = datetime.datetime.now(timezone)
+def journal_payload(payload: dict) -> dict:
+    return {
+        "server": payload["server"],
+        "channel": payload["channel"],
+        "message": payload["message"],
+        "url": payload["url"],
+        "notice": payload["notice"],
+        "description": payload["description"],
+        "event_time": payload["event_time"],
+        "notice_time": payload["notice_time"],
+    }
 
-        print(f"Event start time: {event_start_time}")
-        print(f"Monitor start time: {monitor_start_time}")
-        print(f"Now: {now}")
-        if now < monitor_start_time:
-            logger.debug(f"Event not yet in monitoring range: {info['url']}")
+async def restore_notifications():
+    # Rebuilds the queue and the sent index from the journal, without any network access.
+    # Pending reminders are kept only while the registration that queued them still exists.
+    rows_by_path = await events.get_event_rows_by_path()
+    registered = {(path, info["server"], info["channel"], info["notice"]) for path, rows in rows_by_path.items() for info in rows}
+    channels = {target[:3] for target in registered}
+    pending, sent = await journal.replay_async()
+    for key, expires in sent.items():
+        sent_notifications.add(key, expires)
+    restored = 0
+    for key, record in pending.items():
+        payload = {**record["payload"], "key": key, "expires": record["expires"]}
+        # Journals written before the notice was recorded are matched on the channel alone
+        notice = payload.get("notice")
+        if notice is None:
+            known = key[:3] in channels
+        else:
+            known = (*key[:3], notice) in registered
+        if not known:
             continue
+        sent_notifications.add(key, record["expires"])
+        event_queue.push(record["due"], key, payload)
+        restored += 1
+    logger.info(f"Restored {restored} pending and {len(sent)} sent notifications from {journal.path}, dropped {len(pending) - restored} no longer registered")
+    await journal.compact(journal_state)
 
-        logger.debug(f"Monitoring event: {info['url']} Start time: {event_start_time}")
-        for item in items:
-            scheduled_str = item.get("scheduled", None)
-            if not scheduled_str:
-                logger.debug(f"No scheduled time found in item: {item['data'][0]}")
-                break
-            else:
-                pass
-            scheduled_time = datetime.datetime.fromisoformat(scheduled_str)
-            notice_time = scheduled_time - datetime.timedelta(minutes=info["notice"])
-            
-            notification_id = f"{info['server']}_{info['channel']}_{scheduled_time.timestamp()}"
-
-            if now > scheduled_time:
-                if scheduled_time + datetime.timedelta(seconds=item["length_t"]) > now:
-                    if notification_id not in sent_notifications:
-                        logger.debug(f"Program already started: {item['data'][0]}")
-                        description = "\n".join([str(i) for i in item['data']])
-                        embed = discord.Embed(title="Program detail", url=info["url"], color=5025616, description=description, timestamp=scheduled_time)
-                        heapq.heappush(event_queue, (float(notice_time.timestamp()), {
-                            "server": info["server"],
-                            "channel": info["channel"],
-                            "message": f"{event_data['schedule']['name']}'s next program is already started in {int((now - scheduled_time).total_seconds() / 60)} minutes ago!",
-                            "embed": embed,
-                            "event_time": scheduled_time,
-                            "timezone": timezone
-                        }))
-                        sent_notifications.add(notification_id)
-                    else:
-                        logger.debug(f"Program notice already sent: {item['data'][0]}")
-                        continue
-                else:
-                    logger.debug(f"Program are already finished: {item['data'][0]}")
-                    continue
-            else:
-                pass
+def journal_state() -> tuple[list, list]:
+    pending = [(payload["key"], due, payload["expires"], journal_payload(payload)) for due, _, payload in event_queue.items()]
+    pending_keys = {key for key, _, _, _ in pending}
+    sent = [(key, expires) for key, expires in sent_notifications.expires.items() if key not in pending_keys]
+    return pending, sent
 
-            if (scheduled_time - now).total_seconds() > 3600 * env.SCHEDULE_NOTIFICATIONS_INTERVAL:
-                logger.debug(f"Event too far in the future: {item['data'][0]}")
-                break
-            else:
-                pass
-
-            if (scheduled_time < now and scheduled_time + datetime.timedelta(seconds=info["notice"]) > now):
-                if notification_id not in sent_notifications:
-                    logger.debug(f"Program notify deley: {item['data'][0]}")
-                    description = "\n".join([str(i) for i in item['data']])
-                    embed = discord.Embed(title="Program detail", url=info["url"], color=5025616, description=description, timestamp=scheduled_time)
-                    time_diff = now.timestamp() - (scheduled_time - datetime.timedelta(minutes=info['notice'])).timestamp()
-                    minutes_diff = int(time_diff / 60)
-                    heapq.heappush(event_queue, (float(notice_time.timestamp()), {
-                        "server": info["server"],
-                        "channel": info["channel"],
-                        "message": f"{event_data['schedule']['name']}'s next program will start in {minutes_diff} minutes!",
-                        "embed": embed,
-                        "event_time": scheduled_time,
-                        "timezone": timezone
-                    }))
-                    sent_notifications.add(notification_id)
-                    continue
-                else:
-                    logger.debug(f"Program notice already sent: {item['data'][0]}")
-                    continue
-
-            if not is_duplicate_event(event_queue, float(notice_time.timestamp()), info["server"], info["channel"], scheduled_time):
-                if notification_id not in sent_notifications:
-                    logger.debug(f"Scheduled notification: {item['data'][0]} Notice time: {notice_time}")
-
-                    description = "\n".join([str(i) for i in item['data']])
-                    embed = discord.Embed(title="Program detail", url=info["url"], color=5025616, description=description, timestamp=scheduled_time)
-                    heapq.heappush(event_queue, (float(notice_time.timestamp()), {
-                        "server": info["server"],
-                        "channel": info["channel"],
-                        "message": f"{event_data['schedule']['name']}'s next program will start in {info['notice']} minutes!",
-                        "embed": embed,
-                        "event_time": scheduled_time,
-                        "timezone": timezone
-                    }))
-                    sent_notifications.add(notification_id)
-                else:
-                    logger.debug(f"Program notice already sent: {item['data'][0]}")
+def maybe_compact_journal():
+    if journal.needs_compaction(len(sent_notifications)):
+        journal.compact_later(journal_state)
+
+def in_monitoring_range(info, schedule: CompactSchedule, now: float, window: float) -> bool:
+    if len(schedule) == 0:
+        logger.debug(f"No items found in event data: {info['url']}")
+        return False
+
+    if schedule.start is None:
+        logger.debug(f"No start time found in event data: {info['url']}")
+        return False
+
+    monitor_start_time = schedule.start - int(info["notice"]) * 60 - window
+    if now < monitor_start_time:
+        logger.debug(f"Event not yet in monitoring range: {info['url']}")
+        return False
+    return True
+
+def queue_item(info, path: str, schedule: CompactSchedule, index: int, now: float, started: bool):
+    scheduled_time = schedule.starts[index]
+    if notification_key(path, info, scheduled_time) in sent_notifications:
+        logger.debug(f"Program notice already sent: {schedule.titles[index]}")
+        return
+
+    if started:
+        logger.debug(f"Program already started: {schedule.titles[index]}")
+        message = f"{schedule.name}'s next program is already started in {int((now - scheduled_time) / 60)} minutes ago!"
+    elif scheduled_time - int(info["notice"]) * 60 < now:
+        logger.debug(f"Program notify deley: {schedule.titles[index]}")
+        message = f"{schedule.name}'s next program will start in {int((scheduled_time - now) / 60)} minutes!"
+    else:
+        message = f"{schedule.name}'s next program will start in {info['notice']} minutes!"
+    queue_notification(info, path, schedule, index, message)
+
+def schedule_items(info, path: str, schedule: CompactSchedule, indexes, now: float, window: float):
+    # `indexes` must be in schedule order
+    for index in indexes:
+        title = schedule.titles[index]
+        scheduled_time = schedule.starts[index]
+
+        if now > scheduled_time:
+            if scheduled_time + schedule.lengths[index] > now:
+                queue_item(info, path, schedule, index, now, True)
             else:
-                logger.debug(f"Duplicate event found: {item['data'][0]}")
+                logger.debug(f"Program are already finished: {title}")
+            continue
+
+        if scheduled_time - now > window:
+            logger.debug(f"Event too far in the future: {title}")
+            break
 
-async def process_event_queue():
-    while True:
-        if not event_queue or event_queue is []:
-            await asyncio.sleep(1)
+        queue_item(info, path, schedule, index, now, False)
+
+def schedule_batch(rows_by_path: dict[str, list[dict]], schedules: dict[str, Optional[CompactSchedule]], now: float, window: float):
+    # Same result as schedule_event for every registration, with the due items found in one vectorized pass
+    paths = list(rows_by_path)
+    schedule_list = [schedules.get(path) for path in paths]
+    infos: list[dict] = []
+    schedule_ids: list[int] = []
+    for schedule_id, path in enumerate(paths):
+        infos.extend(rows_by_path[path])
+        schedule_ids.extend([schedule_id] * len(rows_by_path[path]))
+    registrations, items, started = due_engine.compute_due(
+        schedule_list, schedule_ids, [int(info["notice"]) for info in infos], now, window
+    )
+    # Expired once for the whole pass; most due items of a repeat pass are already queued
+    sent_notifications.expire(now)
+    sent = sent_notifications.expires
+    queued = 0
+    for registration, index, is_started in zip(registrations.tolist(), items.tolist(), started.tolist()):
+        info = infos[registration]
+        schedule_id = schedule_ids[registration]
+        schedule = schedule_list[schedule_id]
+        if notification_key(paths[schedule_id], info, schedule.starts[index]) in sent: # type: ignore
             continue
+        queue_item(info, paths[schedule_id], schedule, index, now, is_started) # type: ignore
+        queued += 1
+    logger.debug(f"Batch scheduling: {len(infos)} registrations, {len(registrations)} due items, {queued} queued")
 
-        notice_timestamp, notification_info = heapq.heappop(event_queue)
-        notice_time = datetime.datetime.fromtimestamp(notice_timestamp, tz=notification_info["timezone"])
-        now = datetime.datetime.now(notification_info["timezone"])
+def schedule_event(info, path: str, schedule: CompactSchedule, now: float, window: float, ticker: Optional[CompactSchedule] = None):
+    if not in_monitoring_range(info, schedule, now, window):
+        return
 
-        wait_seconds = (notice_time - now).total_seconds()
-        if wait_seconds > 0:
-            await asyncio.sleep(wait_seconds)
-            logger.debug(f"Sending notification: {notification_info['message']}")
-            await send_notification(
-                notification_info["server"],
-                notification_info["channel"],
-                notification_info["message"],
-                notification_info["embed"]
-            )
+    logger.debug(f"Monitoring event: {info['url']} Start time: {schedule.start}")
+    if ticker is not None:
+        # The ticker knows which program is really running; the full schedule covers the ones after it
+        schedule = schedule.with_ticker(ticker, now)
+    schedule_items(info, path, schedule, range(schedule.first_unfinished(now), len(schedule)), now, window)
+
+async def schedule_registration(info):
+    schedule = await fetch_json.get_compact(info["url"])
+    if schedule is None:
+        logger.debug(f"Failed to get event data: {info['url']}")
+        return
+    ticker = await fetch_json.get_live_ticker(info["url"], schedule)
+    path = fetch_json.get_schedule_path(info["url"])
+    schedule_event(info, path, schedule, time.time(), 3600 * env.SCHEDULE_NOTIFICATIONS_INTERVAL, ticker)
+
+@metrics.timed("schedule_notifications_seconds")
+async def schedule_notifications(fetch_missing: bool = True):
+    logger.debug("Scheduling notifications start...")
+    rows_by_path = await events.get_event_rows_by_path()
+    window = 3600 * env.SCHEDULE_NOTIFICATIONS_INTERVAL
+
+    # Each schedule is loaded once, however many guilds registered it
+    schedules: dict[str, Optional[CompactSchedule]] = {}
+    tickers: dict[str, CompactSchedule] = {}
+    for path, rows in rows_by_path.items():
+        url = rows[0]["url"]
+        if fetch_missing:
+            schedule = await fetch_json.get_compact(url)
         else:
+            schedule = await fetch_json.load_compact(fetch_json.get_cache_path(url))
+        schedules[path] = schedule
+        if schedule is None:
+            logger.debug(f"Failed to get event data: {url}")
+            continue
+        # The startup pass stays offline; later passes check live events against the ticker
+        ticker = await fetch_json.get_live_ticker(url, schedule) if fetch_missing else None
+        if ticker is not None:
+            tickers[path] = ticker
+
+    now = time.time()
+    for path, ticker in tickers.items():
+        schedules[path] = schedules[path].with_ticker(ticker, now) # type: ignore
+    schedule_batch(rows_by_path, schedules, now, window)
+
+    sent_notifications.expire()
+    maybe_compact_journal()
+    logger.debug(f"Queued: {len(event_queue)} Sent index: {sent_notifications.stats()} Delivery: {delivery.stats()}")
+    logger.debug(f"Schedule cache: {fetch_json.schedule_cache.stats()} Compact cache: {fetch_json.compact_cache.stats()}")
+
+async def reschedule(path: str, previous: Optional[CompactSchedule], schedule: CompactSchedule):
+    # Called when a schedule is saved: only the items that changed since `previous` are touched
+    removed, added = diff_items(previous, schedule)
+    if not removed and not added:
+        logger.debug(f"Schedule unchanged: {path}")
+        return
+
+    registrations = await events.get_event_rows_path(path)
+    if not registrations:
+        return
+
+    now = time.time()
+    window = 3600 * env.SCHEDULE_NOTIFICATIONS_INTERVAL
+    cancelled = 0
+    for info in registrations:
+        for index in removed:
+            key = notification_key(path, info, previous.starts[index]) # type: ignore
+            # Only pending reminders are withdrawn; one that was already sent stays recorded
+            if event_queue.cancel(key):
+                sent_notifications.discard(key)
+                journal.record_cancelled(key)
+                cancelled += 1
+        if added and in_monitoring_range(info, schedule, now, window):
+            schedule_items(info, path, schedule, added, now, window)
+    logger.debug(f"Rescheduled {path}: {len(removed)} removed, {len(added)} added, {cancelled} cancelled for {len(registrations)} registrations")
+
+async def deliver_notifications(notifications: list[dict]):
+    now = time.time()
+    for notification_info in notifications:
+        if now - notification_info["notice_time"] > 1:
             logger.debug(f"Sending notification delay: {notification_info['message']}")
-            await send_notification(
-                notification_info["server"],
-                notification_info["channel"],
-                notification_info["message"],
-                notification_info["embed"]
-            )
-
-def is_duplicate_event(event_queue, notice_timestamp, server, channel, event_time):
-    for event in event_queue:
-        if (abs(event[0] - notice_timestamp) < 1.0 and
-            event[1]["server"] == server and
-            event[1]["channel"] == channel and
-            event[1]["event_time"] == event_time):
-            return True
-    return False
+        else:
+            logger.debug(f"Sending notification: {notification_info['message']}")
+        delivery.enqueue(notification_info["channel"], notification_info)
+
+def start_event_queue():
+    event_queue.start()
+
+def delivery_stats() -> dict:
+    return delivery.stats()
+
+
+event_queue = NotificationScheduler(deliver_notifications)
+delivery = ChannelDelivery(send_notifications, embed_length, env.DELIVERY_WINDOW, env.DELIVERY_RATE, env.DELIVERY_BURST)
+
+metrics.describe("notification_lag_seconds", "histogram", "Delay between the notice time and the Discord send")
+metrics.describe("schedule_notifications_seconds", "histogram", "Duration of a schedule_notifications pass")
+metrics.describe("discord_command_seconds", "histogram", "Latency of slash command handlers")
+metrics.gauge("notification_queue_depth", "Notifications waiting for their notice time", lambda: len(event_queue))
+metrics.gauge("notification_sent_index_size", "Entries in the sent notification index", lambda: len(sent_notifications.expires))
+metrics.gauge("delivery_pending", "Notifications waiting to be merged and sent", lambda: delivery.stats()["pending"])
+for _stat in ("sent", "merged", "throttled"):
+    metrics.counter(f"delivery_{_stat}_total", f"Channel delivery {_stat}", functools.partial(metrics.read_stat, delivery_stats, _stat))
@@ -0,0 +1,106 @@
+from loguru import logger
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+# Entries sharing a due time are fired in insertion order
+DUE, SEQ, KEY, PAYLOAD = range(4)
+
+
+class NotificationScheduler:
+    def __init__(self, callback: Callable[[list[Any]], Awaitable[None]]):
+        self.callback = callback
+        self.heap: list[list] = []
+        self.entries: dict[Hashable, list] = {}
+        self._counter = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_due: Optional[float] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        return entry[PAYLOAD] if entry is not None else None
+
+    def items(self):
+        return [(entry[DUE], entry[KEY], entry[PAYLOAD]) for entry in self.entries.values()]
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._arm()
+
+    def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        self._timer_due = None
+        self._loop = None
+
+    def push(self, due: float, key: Hashable, payload: Any) -> None:
+        # Pushing an existing key moves it to the new due time
+        self.cancel(key, rearm=False)
+        entry = [due, next(self._counter), key, payload]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        if self._timer_due is None or due < self._timer_due:
+            self._arm()
+
+    def cancel(self, key: Hashable, rearm: bool = True) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[KEY] = None # lazily dropped from the heap
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.entries):
+            self.heap = [e for e in self.heap if e[KEY] is not None]
+            heapq.heapify(self.heap)
+        if rearm and entry[DUE] == self._timer_due:
+            self._arm()
+        return True
+
+    def _peek(self) -> Optional[list]:
+        while self.heap and self.heap[0][KEY] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
+
+    def _arm(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_due = None
+        if self._loop is None:
+            return
+        entry = self._peek()
+        if entry is None:
+            return
+        delay = max(0.0, entry[DUE] - time.time())
+        self._timer = self._loop.call_at(self._loop.time() + delay, self._fire)
+        self._timer_due = entry[DUE]
+
+    def _fire(self) -> None:
+        self._timer = None
+        self._timer_due = None
+        now = time.time()
+        due = []
+        while (entry := self._peek()) is not None and entry[DUE] <= now:
+            heapq.heappop(self.heap)
+            del self.entries[entry[KEY]]
+            due.append(entry[PAYLOAD])
+        if due:
+            task = asyncio.ensure_future(self._dispatch(due))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._arm()
+
+    async def _dispatch(self, payloads: list[Any]) -> None:
+        try:
+            await self.callback(payloads)
+        except Exception as e:
+            logger.exception(f"Failed to dispatch {len(payloads)} notifications: {e}")
@@ -12,6 +12,51 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN") or "YOUR_DISCORD_BOT_TOKEN"
 # Files
 CACHE_DIR = os.getenv("CACHE_DIR") or "./cache"
 EVENTS = os.getenv("EVENTS") or "events.csv"
+NOTIFY_JOURNAL = os.getenv("NOTIFY_JOURNAL") or "notifications.journal"
+NOTIFY_JOURNAL_COMPACT = int(os.getenv("NOTIFY_JOURNAL_COMPACT") or 10000) # records
+
+# Event storage backend ("csv" or "sqlite")
+EVENTS_BACKEND = (os.getenv("EVENTS_BACKEND") or "csv").lower()
+EVENTS_DB = os.getenv("EVENTS_DB") or "events.db"
+PERSIST_WINDOW = float(os.getenv("PERSIST_WINDOW") or 0.2) # seconds
+
+# In-memory cache of parsed schedules
+SCHEDULE_CACHE_MAX_MB = float(os.getenv("SCHEDULE_CACHE_MAX_MB") or 64)
+SCHEDULE_CACHE_RECHECK = float(os.getenv("SCHEDULE_CACHE_RECHECK") or 30) # seconds
+
+# Schedules cached in CACHE_DIR
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB") or 1024)
+CACHE_GC_INTERVAL = float(os.getenv("CACHE_GC_INTERVAL") or 1) # hours
+
+# Notification delivery
+DELIVERY_WINDOW = float(os.getenv("DELIVERY_WINDOW") or 1) # seconds
+DELIVERY_RATE = float(os.getenv("DELIVERY_RATE") or 1) # messages per second per channel
+DELIVERY_BURST = float(os.getenv("DELIVERY_BURST") or 5)
+
+# Fetching
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY") or 8)
+FETCH_RATE_PER_HOST = float(os.getenv("FETCH_RATE_PER_HOST") or 2) # requests per second
+FETCH_BURST_PER_HOST = float(os.getenv("FETCH_BURST_PER_HOST") or 4)
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT") or 30) # seconds
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES") or 3)
+FETCH_RETRY_BACKOFF = float(os.getenv("FETCH_RETRY_BACKOFF") or 1) # seconds
+FETCH_RETRY_MAX_DELAY = float(os.getenv("FETCH_RETRY_MAX_DELAY") or 30) # seconds
+NOT_FOUND_TTL = float(os.getenv("NOT_FOUND_TTL") or 3600) # seconds
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES") or 5)
+CIRCUIT_RESET = float(os.getenv("CIRCUIT_RESET") or 60) # seconds
+
+# Refresh planning
+REFRESH_CHECK_INTERVAL = float(os.getenv("REFRESH_CHECK_INTERVAL") or 1) # minutes
+REFRESH_LIVE_INTERVAL = float(os.getenv("REFRESH_LIVE_INTERVAL") or 5) # minutes
+REFRESH_ENDED_GRACE = float(os.getenv("REFRESH_ENDED_GRACE") or 6) # hours
+REFRESH_BUDGET_PER_HOUR = int(os.getenv("REFRESH_BUDGET_PER_HOUR") or 600) # requests
+
+# Live status from Horaro's ticker (0 disables it)
+TICKER_INTERVAL = float(os.getenv("TICKER_INTERVAL") or 60) # seconds
+
+# Metrics (disabled when METRICS_PORT is 0)
+METRICS_HOST = os.getenv("METRICS_HOST") or "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
 
 # Language
 LANG = os.getenv("LANG") or "en"
@@ -0,0 +1,167 @@
+from loguru import logger
+import asyncio
+import aiofiles
+import csv
+import io
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import src.env as env
+from src.persistence import WriteCoalescer
+
+COLUMNS = ["url", "notice", "server", "channel"]
+
+def parse_rows(content: str) -> list[dict]:
+    return [
+        {"url": row["url"], "notice": int(row["notice"]), "server": int(row["server"]), "channel": int(row["channel"])}
+        for row in csv.DictReader(io.StringIO(content))
+    ]
+
+def format_rows(rows) -> str:
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue()
+
+async def read_rows_async(file_path) -> list[dict]:
+    loop = asyncio.get_event_loop()
+    async with aiofiles.open(file_path, mode='r', encoding='utf-8') as f:
+        content = await f.read()
+    return await loop.run_in_executor(None, parse_rows, content)
+
+
+class CsvEventStore:
+    def __init__(self, path: str, window: float = 0.0):
+        self.path = path
+        self._registry = None
+        # Bursts of changes are written once, through a temp file and rename
+        self._writer = WriteCoalescer(path, self._snapshot, lambda rows: format_rows(rows).encode("utf-8"), window)
+
+    def _snapshot(self) -> list[dict]:
+        return [dict(row) for row in self._registry.rows.values()] if self._registry is not None else []
+
+    async def load(self) -> list[dict]:
+        if not os.path.exists(self.path):
+            return []
+        return await read_rows_async(self.path)
+
+    async def _rewrite(self, registry) -> None:
+        self._registry = registry
+        await self._writer.request()
+
+    async def add(self, registry, row: dict) -> None:
+        await self._rewrite(registry)
+
+    async def remove(self, registry, url: str) -> None:
+        await self._rewrite(registry)
+
+    async def update(self, registry, old_url: str, changes: dict) -> None:
+        await self._rewrite(registry)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    notice INTEGER NOT NULL,
+    server INTEGER NOT NULL,
+    channel INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_url ON events (url);
+CREATE INDEX IF NOT EXISTS idx_events_server ON events (server);
+CREATE INDEX IF NOT EXISTS idx_events_channel ON events (channel);
+"""
+
+def connect_sqlite(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def migrate_csv_to_sqlite(conn: sqlite3.Connection, csv_path: str) -> int:
+    # One-shot: user_version is bumped after the first import so an emptied table is not refilled
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+        return 0
+    migrated = 0
+    if os.path.exists(csv_path):
+        with open(csv_path, 'r', encoding='utf-8') as f:
+            rows = [(r["url"], r["notice"], r["server"], r["channel"]) for r in parse_rows(f.read())]
+        with conn:
+            conn.executemany("INSERT INTO events (url, notice, server, channel) VALUES (?, ?, ?, ?)", rows)
+        migrated = len(rows)
+        logger.info(f"Migrated {migrated} events from {csv_path}")
+    conn.execute("PRAGMA user_version = 1")
+    return migrated
+
+
+class SqliteEventStore:
+    def __init__(self, db_path: str, csv_path: str):
+        self.db_path = db_path
+        self.csv_path = csv_path
+        self._conn: sqlite3.Connection | None = None
+        # A single worker thread owns the connection and serializes every transaction
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="events-sqlite")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = connect_sqlite(self.db_path)
+            migrate_csv_to_sqlite(self._conn, self.csv_path)
+        return self._conn
+
+    def _load(self) -> list[dict]:
+        rows = self._connection().execute("SELECT url, notice, server, channel FROM events ORDER BY id").fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def _add(self, row: dict) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO events (url, notice, server, channel) VALUES (?, ?, ?, ?)",
+                (row["url"], row["notice"], row["server"], row["channel"])
+            )
+
+    def _remove(self, url: str) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM events WHERE url = ?", (url,))
+
+    def _update(self, old_url: str, changes: dict) -> None:
+        if not changes:
+            return
+        assignments = ", ".join(f"{column} = ?" for column in changes) # columns come from update_event, not user input
+        with self._connection() as conn:
+            conn.execute(f"UPDATE events SET {assignments} WHERE url = ?", (*changes.values(), old_url))
+
+    async def load(self) -> list[dict]:
+        return await self._run(self._load)
+
+    async def add(self, registry, row: dict) -> None:
+        await self._run(self._add, row)
+
+    async def remove(self, registry, url: str) -> None:
+        await self._run(self._remove, url)
+
+    async def update(self, registry, old_url: str, changes: dict) -> None:
+        await self._run(self._update, old_url, changes)
+
+
+def create_store():
+    if env.EVENTS_BACKEND == "sqlite":
+        logger.info(f"Using SQLite event store: {env.EVENTS_DB}")
+        return SqliteEventStore(env.EVENTS_DB, env.EVENTS)
+    if env.EVENTS_BACKEND != "csv":
+        logger.warning(f"Unknown EVENTS_BACKEND '{env.EVENTS_BACKEND}', falling back to csv")
+    return CsvEventStore(env.EVENTS, env.PERSIST_WINDOW)
+
+# Migrate an existing CSV (events.csv or events.EXAMPLE.csv format) into a SQLite database
+if __name__ == '__main__':
+    import sys
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else env.EVENTS
+    db_path = sys.argv[2] if len(sys.argv) > 2 else env.EVENTS_DB
+    migrate_csv_to_sqlite(connect_sqlite(db_path), csv_path)
+    logger.info("Finished")
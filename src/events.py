@@ -1,102 +1,212 @@
 from loguru import logger
 import asyncio
-import aiofiles
-import io
-import pandas as pd
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 import src.env as env
+import src.event_store as event_store
 import src.fetch_json as fetch_json
-
-async def read_csv_async(file_path):
-    loop = asyncio.get_event_loop()
-    async with aiofiles.open(file_path, mode='r') as f:
-        content = await f.read()
-    df = await loop.run_in_executor(None, lambda: pd.read_csv(io.StringIO(content)))
-    return df
-
-async def to_csv_async(df, file_path):
-    loop = asyncio.get_event_loop()
-    csv_content = await loop.run_in_executor(None, lambda: df.to_csv(index=False))
-    async with aiofiles.open(file_path, mode='w', newline='') as f:
-        await f.write(csv_content)
+from src.event_store import COLUMNS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+class EventRegistry:
+    def __init__(self):
+        self.rows: dict[int, dict] = {}
+        self.next_id = 0
+        self.by_url: dict[str, set[int]] = {}
+        self.by_notice: dict[int, set[int]] = {}
+        self.by_server: dict[int, set[int]] = {}
+        self.by_channel: dict[int, set[int]] = {}
+        self.by_url_server: dict[tuple[str, int], set[int]] = {}
+        self.by_path: dict[str, set[int]] = {}
+        self._frame: Optional["pd.DataFrame"] = None
+
+    def _indexes(self, row: dict):
+        return (
+            (self.by_url, row["url"]),
+            (self.by_notice, row["notice"]),
+            (self.by_server, row["server"]),
+            (self.by_channel, row["channel"]),
+            (self.by_url_server, (row["url"], row["server"])),
+            (self.by_path, fetch_json.get_schedule_path(row["url"])),
+        )
+
+    def _index(self, row_id: int, row: dict):
+        for index, key in self._indexes(row):
+            index.setdefault(key, set()).add(row_id)
+
+    def _unindex(self, row_id: int, row: dict):
+        for index, key in self._indexes(row):
+            ids = index.get(key)
+            if ids is None:
+                continue
+            ids.discard(row_id)
+            if not ids:
+                del index[key]
+
+    def add(self, url: str, notice: int, server: int, channel: int) -> dict:
+        row = {"url": url, "notice": int(notice), "server": int(server), "channel": int(channel)}
+        row_id = self.next_id
+        self.next_id += 1
+        self.rows[row_id] = row
+        self._index(row_id, row)
+        self._frame = None
+        return row
+
+    def remove_url(self, url: str) -> int:
+        ids = list(self.by_url.get(url, ()))
+        for row_id in ids:
+            self._unindex(row_id, self.rows.pop(row_id))
+        self._frame = None
+        return len(ids)
+
+    def update_url(self, old_url: str, changes: dict) -> int:
+        ids = list(self.by_url.get(old_url, ()))
+        for row_id in ids:
+            row = self.rows[row_id]
+            self._unindex(row_id, row)
+            row.update(changes)
+            self._index(row_id, row)
+        self._frame = None
+        return len(ids)
+
+    def select_rows(self, ids) -> list[dict]:
+        return [self.rows[i] for i in sorted(ids)]
+
+    def select(self, ids) -> "pd.DataFrame":
+        # pandas is imported on first use so that startup does not pay for it
+        import pandas as pd
+        return pd.DataFrame(self.select_rows(ids), columns=COLUMNS)
+
+    def frame(self) -> "pd.DataFrame":
+        if self._frame is None:
+            self._frame = self.select(self.rows.keys())
+        return self._frame
+
+    def load_rows(self, rows: list[dict]):
+        for row in rows:
+            self.add(row["url"], row["notice"], row["server"], row["channel"])
+
+
+registry: Optional[EventRegistry] = None
+store = event_store.create_store()
+generation = 0 # bumped on every change to the registrations
+_registry_lock = asyncio.Lock()
+
+async def load_events() -> EventRegistry:
+    global registry
+    async with _registry_lock:
+        if registry is None:
+            loaded = EventRegistry()
+            loaded.load_rows(await store.load())
+            registry = loaded
+            bump_generation()
+            logger.info(f"Loaded {len(loaded.rows)} events")
+    return registry
+
+def bump_generation():
+    global generation
+    generation += 1
+
+async def get_registry() -> EventRegistry:
+    if registry is not None:
+        return registry
+    return await load_events()
 
 async def add_event(url: str, notice: int, server: int, channel: int) -> None:
-    df = await read_csv_async(env.EVENTS)
-
-    new_event = pd.DataFrame({
-        "url": [url],
-        "notice": [notice],
-        "server": [server],
-        "channel": [channel]
-    })
-
-    df = pd.concat([df, new_event], ignore_index=True)
-    await to_csv_async(df, env.EVENTS)
+    reg = await get_registry()
+    row = reg.add(url, notice, server, channel)
+    bump_generation()
+    await store.add(reg, row)
     logger.debug(f"Added new event: {url}")
 
 async def remove_event(url) -> None:
-    df = await read_csv_async(env.EVENTS)
-
-    df = df[df["url"] != url]
-    await to_csv_async(df, env.EVENTS)
+    reg = await get_registry()
+    reg.remove_url(url)
+    bump_generation()
+    await store.remove(reg, url)
     logger.debug(f"Removed event: {url}")
 
 async def update_event(old_url: str, new_url: Optional[str] = None, notice: Optional[int] = None, server: Optional[int] = None, channel: Optional[int] = None) -> None:
-    df = await read_csv_async(env.EVENTS)
+    reg = await get_registry()
 
+    changes: dict[str, str | int] = {}
     if new_url is not None:
-        df.loc[df["url"] == old_url, "url"] = new_url
+        changes["url"] = new_url
     if notice is not None:
-        df.loc[df["url"] == old_url, "notice"] = notice
+        changes["notice"] = int(notice)
     if server is not None:
-        df.loc[df["url"] == old_url, "server"] = server
+        changes["server"] = int(server)
     if channel is not None:
-        df.loc[df["url"] == old_url, "channel"] = channel
+        changes["channel"] = int(channel)
 
-    await to_csv_async(df, env.EVENTS)
+    reg.update_url(old_url, changes)
+    bump_generation()
+    await store.update(reg, old_url, changes)
     data = await fetch_json.fetch_json(new_url if new_url is not None else old_url)
     await fetch_json.save_json(data, env.CACHE_DIR) # type:ignore
     logger.info(f"Updated event: {old_url}")
 
-async def get_events() -> pd.DataFrame:
-    df = await read_csv_async(env.EVENTS)
-    return df
-
-async def get_events_url(url: str) -> pd.DataFrame:
-    df = await read_csv_async(env.EVENTS)
-    return df[df["url"] == url]
-
-async def get_events_notice(notice: int) -> pd.DataFrame:
-    df = await read_csv_async(env.EVENTS)
-    return df[df["notice"] == notice]
-
-async def get_events_server(server: int) -> pd.DataFrame:
-    df = await read_csv_async(env.EVENTS)
-    return df[df["server"] == server]
-
-async def get_events_channel(channel: int) -> pd.DataFrame:
-    df = await read_csv_async(env.EVENTS)
-    return df[df["channel"] == channel]
-
-async def get_events_multiple(url: Optional[str] = None, notice: Optional[int] = None, server: Optional[int] = None, channel: Optional[int] = None) -> pd.DataFrame:
-    df = await read_csv_async(env.EVENTS)
-    conditions = []
-    if url is not None:
-        conditions.append(df["url"] == url)
+async def get_event_rows() -> list[dict]:
+    reg = await get_registry()
+    return list(reg.rows.values())
+
+async def get_event_rows_path(path: str) -> list[dict]:
+    reg = await get_registry()
+    return reg.select_rows(reg.by_path.get(path.lstrip("/"), ()))
+
+async def get_event_rows_by_path() -> dict[str, list[dict]]:
+    reg = await get_registry()
+    return {path: reg.select_rows(ids) for path, ids in reg.by_path.items()}
+
+async def get_schedule_urls() -> dict[str, str]:
+    # One registered URL per schedule path, read from the path index instead of every row
+    reg = await get_registry()
+    return {path: reg.rows[next(iter(ids))]["url"] for path, ids in reg.by_path.items()}
+
+async def get_event_rows_server(server: int) -> list[dict]:
+    reg = await get_registry()
+    return reg.select_rows(reg.by_server.get(server, ()))
+
+async def get_events() -> "pd.DataFrame":
+    reg = await get_registry()
+    return reg.frame()
+
+async def get_events_url(url: str) -> "pd.DataFrame":
+    reg = await get_registry()
+    return reg.select(reg.by_url.get(url, ()))
+
+async def get_events_notice(notice: int) -> "pd.DataFrame":
+    reg = await get_registry()
+    return reg.select(reg.by_notice.get(notice, ()))
+
+async def get_events_server(server: int) -> "pd.DataFrame":
+    reg = await get_registry()
+    return reg.select(reg.by_server.get(server, ()))
+
+async def get_events_channel(channel: int) -> "pd.DataFrame":
+    reg = await get_registry()
+    return reg.select(reg.by_channel.get(channel, ()))
+
+async def get_events_multiple(url: Optional[str] = None, notice: Optional[int] = None, server: Optional[int] = None, channel: Optional[int] = None) -> "pd.DataFrame":
+    reg = await get_registry()
+    candidates = []
+    if url is not None and server is not None:
+        candidates.append(reg.by_url_server.get((url, server), set()))
+    elif url is not None:
+        candidates.append(reg.by_url.get(url, set()))
+    elif server is not None:
+        candidates.append(reg.by_server.get(server, set()))
     if notice is not None:
-        conditions.append(df["notice"] == notice)
-    if server is not None:
-        conditions.append(df["server"] == server)
+        candidates.append(reg.by_notice.get(notice, set()))
     if channel is not None:
-        conditions.append(df["channel"] == channel)
-
-    if conditions:
-        combined_conditions = conditions[0]
-        for condition in conditions[1:]:
-            combined_conditions &= condition
-        return df[combined_conditions]
-    return df
+        candidates.append(reg.by_channel.get(channel, set()))
+
+    if candidates:
+        candidates.sort(key=len)
+        return reg.select(set.intersection(*candidates) if len(candidates) > 1 else candidates[0])
+    return reg.frame()
 
 # test code
 #if __name__ == '__main__':
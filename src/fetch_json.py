@@ -1,89 +1,536 @@
 from loguru import logger
 import asyncio
 import aiohttp
-import pandas as pd
+import aiofiles
+import aiofiles.os
+import functools
 import json
 import os
-from typing import Optional
+import random
+import struct
+import time
+from typing import Mapping, Optional
 from urllib.parse import urlparse
 
 import src.env as env
+import src.metrics as metrics
 import src.dbot.notify as notify
+from src.rate_limit import TokenBucket
+from src.circuit_breaker import CircuitBreaker, CLOSED
+from src.schedule_cache import ScheduleCache, estimate_size
+from src.refresh_planner import RefreshPlanner
+from src.cache_manager import CacheManager
+from src.compact_schedule import CompactSchedule
+from src.schedule_stream import ScheduleStreamParser, parse_schedule
+from src.persistence import atomic_write, atomic_write_async
 
-async def fetch_json(url: str) -> Optional[dict]:
-    async with aiohttp.ClientSession() as session:
+# SCHEDULE_CACHE_MAX_MB is split evenly between parsed schedules and their compact form
+schedule_cache = ScheduleCache(int(env.SCHEDULE_CACHE_MAX_MB * 1024 * 1024) // 2, env.SCHEDULE_CACHE_RECHECK)
+compact_cache = ScheduleCache(int(env.SCHEDULE_CACHE_MAX_MB * 1024 * 1024) // 2, env.SCHEDULE_CACHE_RECHECK)
+refresh_planner = RefreshPlanner(
+    env.REFRESH_LIVE_INTERVAL * 60,
+    env.FETCH_JSONS_INTERVAL * 3600,
+    env.REFRESH_ENDED_GRACE * 3600,
+    env.REFRESH_BUDGET_PER_HOUR,
+)
+cache_manager = CacheManager(env.CACHE_DIR, int(env.CACHE_MAX_MB * 1024 * 1024), env.CACHE_GC_INTERVAL * 3600)
+
+metrics.describe("horaro_fetch_seconds", "histogram", "Latency of schedule requests to Horaro")
+metrics.describe("horaro_fetch_responses_total", "counter", "Schedule responses from Horaro by status (0 for errors)")
+metrics.describe("horaro_ticker_seconds", "histogram", "Latency of ticker requests to Horaro")
+metrics.describe("horaro_ticker_responses_total", "counter", "Ticker responses from Horaro by status (0 for errors)")
+for _name, _cache in (("schedule", schedule_cache), ("compact", compact_cache)):
+    for _stat in ("hits", "misses", "evictions"):
+        metrics.counter(f"{_name}_cache_{_stat}_total", f"In-memory {_name} cache {_stat}", functools.partial(metrics.read_stat, _cache.stats, _stat))
+    for _stat in ("entries", "bytes"):
+        metrics.gauge(f"{_name}_cache_{_stat}", f"In-memory {_name} cache {_stat}", functools.partial(metrics.read_stat, _cache.stats, _stat))
+metrics.gauge("horaro_not_found_cached", "Schedules skipped after a recent 404", lambda: len(_not_found))
+metrics.gauge("horaro_circuits_open", "URLs whose circuit breaker is not closed", lambda: sum(b.state != CLOSED for b in _circuit_breakers.values()))
+for _stat in ("planned", "finished", "budget_remaining"):
+    metrics.gauge(f"refresh_{_stat}", f"Refresh planner {_stat}", functools.partial(metrics.read_stat, refresh_planner.stats, _stat))
+metrics.counter("refresh_deferred_total", "Due refreshes put off by the hourly budget", lambda: refresh_planner.stats()["deferred"])
+for _stat in ("entries", "bytes"):
+    metrics.gauge(f"disk_cache_{_stat}", f"Schedule cache on disk {_stat}", functools.partial(metrics.read_stat, cache_manager.stats, _stat))
+metrics.counter("disk_cache_evictions_total", "Schedules deleted from the cache on disk", lambda: cache_manager.stats()["evictions"])
+
+_session: Optional[aiohttp.ClientSession] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_host_buckets: dict[str, TokenBucket] = {}
+_inflight: dict[tuple[str, str], asyncio.Future] = {}
+_tickers: dict[str, tuple[float, Optional[CompactSchedule]]] = {} # schedule path -> (fetched at, ticker)
+_not_found: dict[str, float] = {} # schedule path -> monotonic time the 404 expires
+_circuit_breakers: dict[str, CircuitBreaker] = {} # request URL -> breaker, only while it has failures
+_schedule_versions: dict[str, int] = {} # schedule path -> number of saves
+_save_locks: dict[str, asyncio.Lock] = {}
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=env.FETCH_CONCURRENCY, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=env.FETCH_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+async def close_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(env.FETCH_CONCURRENCY)
+    return _semaphore
+
+def get_host_bucket(url: str) -> TokenBucket:
+    host = urlparse(url).netloc
+    bucket = _host_buckets.get(host)
+    if bucket is None:
+        bucket = TokenBucket(env.FETCH_RATE_PER_HOST, env.FETCH_BURST_PER_HOST)
+        _host_buckets[host] = bucket
+    return bucket
+
+def get_circuit_breaker(url: str) -> CircuitBreaker:
+    # One per URL, so a single broken schedule does not block the rest of its host
+    breaker = _circuit_breakers.get(url)
+    if breaker is None:
+        breaker = CircuitBreaker(url, env.CIRCUIT_FAILURES, env.CIRCUIT_RESET)
+        _circuit_breakers[url] = breaker
+    return breaker
+
+def circuit_stats() -> dict[str, dict]:
+    return {url: breaker.stats() for url, breaker in _circuit_breakers.items()}
+
+def get_save_lock(path: str) -> asyncio.Lock:
+    lock = _save_locks.get(path)
+    if lock is None:
+        lock = _save_locks[path] = asyncio.Lock()
+    return lock
+
+def get_schedule_path(url: str) -> str:
+    return urlparse(url).path.lstrip("/") # URLの先頭のスラッシュを削除
+
+def unique_urls(urls: list[str]) -> list[str]:
+    # One URL per schedule path, so each schedule is fetched once however many guilds registered it
+    by_path: dict[str, str] = {}
+    for url in urls:
+        by_path.setdefault(get_schedule_path(url), url)
+    return list(by_path.values())
+
+async def shared(kind: str, url: str, factory):
+    # Concurrent callers for the same schedule path share one in-flight request
+    key = (kind, get_schedule_path(url))
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(factory())
+        _inflight[key] = future
+        def done(_):
+            if _inflight.get(key) is future:
+                del _inflight[key]
+        future.add_done_callback(done)
+    return await asyncio.shield(future)
+
+def get_schedule_version(url: str) -> int:
+    # Changes every time the schedule is saved, so results derived from it can tell they are stale
+    return _schedule_versions.get(get_schedule_path(url), 0)
+
+def get_cache_path(url: str, base_dir: Optional[str] = None) -> str:
+    return os.path.join(base_dir or env.CACHE_DIR, f"{get_schedule_path(url)}.json")
+
+def get_compact_path(path: str) -> str:
+    return f"{path}.compact"
+
+def get_meta_path(path: str) -> str:
+    return f"{path}.meta"
+
+def read_meta(path: str) -> dict:
+    meta_path = get_meta_path(path)
+    if not os.path.exists(meta_path):
+        return {}
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to read {meta_path}: {e}")
+        return {}
+
+def read_metas(paths: list[str]) -> list[dict]:
+    # Runs in a worker thread. Schedules that are not cached have no meta.
+    return [read_meta(path) if os.path.exists(path) else {} for path in paths]
+
+async def read_metas_async(paths: list[str]) -> list[dict]:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, read_metas, paths)
+
+def encode_meta(meta: dict) -> bytes:
+    return json.dumps(meta, ensure_ascii=False).encode("utf-8")
+
+def retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    # Exponential backoff with jitter, or the server's own Retry-After when it sends one
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), env.FETCH_RETRY_MAX_DELAY)
+    delay = min(env.FETCH_RETRY_BACKOFF * 2 ** attempt, env.FETCH_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.0)
+
+async def read_schedule(response: aiohttp.ClientResponse) -> dict:
+    # Parsed while it downloads, keeping only the fields the bot uses
+    parser = ScheduleStreamParser()
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        parser.feed(chunk)
+    return parser.close()
+
+async def send_request(kind: str, request_url: str, headers: dict, projected: bool = False) -> tuple[int, Optional[dict], Mapping[str, str]]:
+    # One HTTP request: (status, JSON body for 200, response headers). Status 0 is a network error.
+    async with get_semaphore():
+        await get_host_bucket(request_url).acquire()
+        start = time.perf_counter()
+        status = 0
+        try:
+            async with get_session().get(request_url, headers=headers) as response:
+                status = response.status
+                body = None
+                if response.status == 200:
+                    body = await read_schedule(response) if projected else await response.json()
+                return response.status, body, response.headers.copy()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"Failed to fetch {request_url}: {e}")
+            status = 0
+            return 0, None, {}
+        finally:
+            metrics.observe(f"horaro_{kind}_seconds", time.perf_counter() - start)
+            metrics.inc(f"horaro_{kind}_responses_total", status=status)
+
+def is_transient(status: int) -> bool:
+    return status == 0 or status == 429 or status >= 500
+
+async def request(kind: str, request_url: str, headers: Optional[dict] = None, projected: bool = False) -> tuple[int, Optional[dict], Mapping[str, str]]:
+    # Retries transient failures, and refuses to send anything while the URL's circuit is open
+    breaker = get_circuit_breaker(request_url)
+    for attempt in range(env.FETCH_RETRIES + 1):
+        if not breaker.allow():
+            logger.debug(f"Circuit for {breaker.name} is {breaker.state}, skipped")
+            return 0, None, {}
+        status = 0
         try:
-            async with session.get(f"{url}.json") as response:
-                if response.status == 404:
-                    logger.error(f"404 Not Found: {url}.json")
-                    return None
-                response.raise_for_status()
-                logger.debug(f"Fetched {url}.json")
-                return await response.json()
-        except aiohttp.ClientError as e:
-            logger.error(f"Failed to fetch {url}.json: {e}")
-            return None
+            status, body, response_headers = await send_request(kind, request_url, headers or {}, projected)
+        finally:
+            # Also when the request raised or was cancelled, so a half-open probe always settles
+            if is_transient(status):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+                _circuit_breakers.pop(request_url, None)
+        if not is_transient(status):
+            return status, body, response_headers
+        if attempt < env.FETCH_RETRIES and breaker.state == CLOSED:
+            delay = retry_delay(attempt, response_headers.get("Retry-After"))
+            logger.warning(f"Status {status} from {request_url}, retry {attempt + 1}/{env.FETCH_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    return 0, None, {}
+
+def is_known_missing(url: str) -> bool:
+    path = get_schedule_path(url)
+    expires = _not_found.get(path)
+    if expires is None:
+        return False
+    if time.monotonic() < expires:
+        return True
+    del _not_found[path]
+    return False
+
+def forget_not_found(url: str) -> None:
+    _not_found.pop(get_schedule_path(url), None)
+
+async def request_json(url: str, validators: Optional[dict] = None) -> tuple[int, Optional[dict], dict]:
+    if is_known_missing(url):
+        logger.debug(f"Skipped {url}.json: answered 404 recently")
+        return 404, None, {}
+
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    status, data, response_headers = await request("fetch", f"{url}.json", headers, projected=True)
+    if status == 304:
+        logger.debug(f"Not modified: {url}.json")
+        return status, None, validators or {}
+    if status == 404:
+        # Remembered for a while, so a removed or mistyped schedule is not requested on every pass
+        _not_found[get_schedule_path(url)] = time.monotonic() + env.NOT_FOUND_TTL
+        logger.error(f"404 Not Found: {url}.json (not requested again for {env.NOT_FOUND_TTL:.0f}s)")
+        return status, None, {}
+    if status != 200 or data is None:
+        if status:
+            logger.error(f"Unexpected status {status} for {url}.json")
+        return 0, None, {}
+    logger.debug(f"Fetched {url}.json")
+    new_validators = {
+        "etag": response_headers.get("ETag"),
+        "last_modified": response_headers.get("Last-Modified"),
+    }
+    return status, data, {k: v for k, v in new_validators.items() if v}
+
+async def fetch_json(url: str) -> Optional[dict]:
+    _, data, _ = await shared("fetch", url, lambda: request_json(url))
+    return data
 
 async def fetch_jsons(urls: list[str]) -> list[dict]:
-    jsons = []
-    for url in urls:
-        json_data = await fetch_json(url)
-        if json_data:
-            jsons.append(json_data)
-        await asyncio.sleep(0.5)
+    results = await asyncio.gather(*(fetch_json(url) for url in unique_urls(urls)))
+    jsons = [json_data for json_data in results if json_data]
     logger.info(f"Fetched {len(jsons)} json files")
     return jsons
 
-async def fetch_jsons_from_csv(csv_path: str) -> list[dict]:
-    urls = pd.read_csv(csv_path)["url"].tolist()
-    logger.debug(f"Fetching {len(urls)} json files")
-    return await fetch_jsons(urls)
+async def update_json(url: str) -> Optional[dict]:
+    # Revalidates the cached copy and returns the new data only when the schedule changed
+    return await shared("update", url, lambda: _update_json(url))
+
+async def _update_json(url: str) -> Optional[dict]:
+    path = get_cache_path(url)
+    meta = (await read_metas_async([path]))[0]
+    status, data, validators = await request_json(url, meta)
+    refresh_planner.invalidate(get_schedule_path(url))
+    if status == 304:
+        meta["checked_at"] = time.time()
+        await atomic_write_async(get_meta_path(path), encode_meta(meta))
+        return None
+    if data:
+        await save_json(data, env.CACHE_DIR, validators)
+    return data
+
+async def order_by_staleness(urls: list[str]) -> list[str]:
+    # Schedules never fetched come first, then the ones checked longest ago
+    metas = await read_metas_async([get_cache_path(url) for url in urls])
+    checked = {url: meta.get("checked_at", 0) for url, meta in zip(urls, metas)}
+    return sorted(urls, key=checked.__getitem__)
+
+async def update_jsons(urls: list[str]) -> list[dict]:
+    schedules = await order_by_staleness(unique_urls(urls))
+    results = await asyncio.gather(*(update_json(url) for url in schedules))
+    jsons = [json_data for json_data in results if json_data]
+    logger.info(f"Updated {len(jsons)} of {len(schedules)} json files ({len(urls)} registrations)")
+    return jsons
+
+def get_ticker_url(url: str) -> Optional[str]:
+    parsed = urlparse(url)
+    parts = get_schedule_path(url).split("/")
+    if len(parts) != 2 or not all(parts):
+        return None
+    return f"{parsed.scheme}://{parsed.netloc}/-/api/v1/events/{parts[0]}/schedules/{parts[1]}/ticker"
+
+async def request_ticker(url: str) -> Optional[CompactSchedule]:
+    ticker_url = get_ticker_url(url)
+    if ticker_url is None:
+        return None
+
+    status, body, _ = await request("ticker", ticker_url)
+    if status != 200 or body is None:
+        logger.debug(f"No ticker for {url} (status {status})")
+        return None
+    try:
+        return CompactSchedule.from_ticker(body["data"])
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Unexpected ticker from {ticker_url}: {e}")
+        return None
+
+async def get_ticker(url: str) -> Optional[CompactSchedule]:
+    # A missing ticker is remembered for the same interval, so the fallback does not retry on every call
+    path = get_schedule_path(url)
+    cached = _tickers.get(path)
+    if cached is not None and time.monotonic() - cached[0] < env.TICKER_INTERVAL:
+        return cached[1]
+    ticker = await shared("ticker", url, lambda: request_ticker(url))
+    _tickers[path] = (time.monotonic(), ticker)
+    return ticker
+
+def is_live(schedule: CompactSchedule, now: float) -> bool:
+    end = schedule.end
+    return len(schedule) > 0 and schedule.start is not None and end is not None and schedule.start <= now <= end
+
+async def get_live_ticker(url: str, schedule: Optional[CompactSchedule]) -> Optional[CompactSchedule]:
+    # The ticker of an event in progress, None when the event is not live or has no ticker
+    if not env.TICKER_INTERVAL or schedule is None or not is_live(schedule, time.time()):
+        return None
+    return await get_ticker(url)
+
+async def plan_refresh(by_path: dict[str, str]) -> list[str]:
+    # Returns the URLs whose own refresh interval has passed, within the hourly request budget.
+    # `by_path` maps each registered schedule path to one of its URLs.
+    now = time.time()
+    refresh_planner.forget(set(by_path))
+    unplanned = [path for path in by_path if not refresh_planner.is_planned(path)]
+    cache_paths = [get_cache_path(by_path[path]) for path in unplanned]
+    for path, cache_path, meta in zip(unplanned, cache_paths, await read_metas_async(cache_paths)):
+        refresh_planner.plan(path, await load_compact(cache_path), meta.get("checked_at", 0), now)
+    return [by_path[path] for path in refresh_planner.select(list(by_path), now)]
 
+async def refresh_jsons(by_path: dict[str, str]) -> list[dict]:
+    due = await plan_refresh(by_path)
+    logger.debug(f"Refresh planner: {len(due)} due, {refresh_planner.stats()}")
+    if not due:
+        return []
+    return await update_jsons(due)
 
-async def save_json(json_data: dict, base_dir: str) -> None:
+
+def encode_schedule(json_data: dict) -> bytes:
+    return json.dumps(json_data, ensure_ascii=False, indent=4).encode("utf-8")
+
+def write_schedule_files(path: str, json_data: dict, compact: CompactSchedule, meta: dict) -> tuple[os.stat_result, os.stat_result, int]:
+    # Runs in a worker thread. The meta goes last: its validators must never describe a body not yet on disk.
+    atomic_write(path, encode_schedule(json_data))
+    atomic_write(get_compact_path(path), compact.to_bytes())
+    atomic_write(get_meta_path(path), encode_meta(meta))
+    return os.stat(path), os.stat(get_compact_path(path)), cache_manager.measure(path)
+
+async def save_json(json_data: dict, base_dir: str, validators: Optional[dict] = None) -> None:
     url_path = json_data["schedule"]["url"].lstrip("/") # URLの先頭のスラッシュを削除
     path = os.path.join(base_dir, f"{url_path}.json")
     logger.debug(f"Saving {path}")
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(json_data, f, ensure_ascii=False, indent=4)
+    # Saves of the same schedule are written in the order they were made
+    async with get_save_lock(path):
+        previous = await load_compact(path)
+        compact = CompactSchedule.from_json(json_data)
+        # Validators always follow the body they belong to, so a stale ETag is never sent for new content
+        now = time.time()
+        meta = {**(validators or {}), "fetched_at": now, "checked_at": now}
+        loop = asyncio.get_event_loop()
+        stat, compact_stat, size = await loop.run_in_executor(None, write_schedule_files, path, json_data, compact, meta)
+        memory = await loop.run_in_executor(None, estimate_size, json_data)
+        cache_manager.record(path, size, compact.end)
+        schedule_cache.put(path, json_data, stat.st_mtime, memory)
+        compact_cache.put(get_compact_path(path), compact, compact_stat.st_mtime, compact.memory_size())
+        _schedule_versions[url_path] = _schedule_versions.get(url_path, 0) + 1
+    await notify.reschedule(url_path, previous, compact)
     return
 
-async def save_jsons(json_datas: list[dict], base_dir: str) -> None:
-    for json_data in json_datas:
-        await save_json(json_data, base_dir)
-    logger.info(f"Saved {len(json_datas)} json files to {base_dir}")
-    return
 
+async def read_schedule_async(path: str) -> dict:
+    # Caches written before projection still hold the full export; they are trimmed on read
+    loop = asyncio.get_event_loop()
+    async with aiofiles.open(path, mode='r', encoding='utf-8') as f:
+        content = await f.read()
+    return await loop.run_in_executor(None, parse_schedule, content)
+
+async def load_json(path: str) -> Optional[dict]:
+    # Reads a cached schedule without touching the network
+    if not schedule_cache.needs_recheck(path):
+        return schedule_cache.get(path)
+
+    try:
+        stat = await aiofiles.os.stat(path)
+    except FileNotFoundError:
+        schedule_cache.invalidate(path)
+        return None
+
+    data = schedule_cache.get(path, stat.st_mtime)
+    if data is None:
+        data = await read_schedule_async(path)
+        loop = asyncio.get_event_loop()
+        schedule_cache.put(path, data, stat.st_mtime, await loop.run_in_executor(None, estimate_size, data))
+    return data
 
 async def get_json(url: str) -> Optional[dict]:
-    parsed_url = urlparse(url)
-    url_path = parsed_url.path.lstrip("/")
-    path = os.path.join(env.CACHE_DIR, f"{url_path}.json")
-    if not os.path.exists(path):
-        logger.warning(f"File not found: {path}")
-        data = await fetch_json(url)
-        if data:
-            await save_json(data, env.CACHE_DIR)
-            return data
-        else:
-            logger.error(f"File not found: {path}")
-            return None
+    path = get_cache_path(url)
+    data = await load_json(path)
+    if data is not None:
+        return data
+
+    if is_known_missing(url):
+        logger.debug(f"File not found and {url} answered 404 recently: {path}")
+        return None
+    logger.warning(f"File not found: {path}")
+    data = await update_json(url)
+    if data:
+        return data
     else:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        logger.error(f"File not found: {path}")
+        return None
 
-async def get_jsons(urls: list[str]) -> list[dict]:
-    jsons = []
-    for u in urls:
-        json_data = await get_json(u)
-        if json_data:
-            jsons.append(json_data)
-    logger.info(f"Got {len(jsons)} json files")
-    return jsons
+def write_compact(compact: CompactSchedule, path: str) -> tuple[os.stat_result, int]:
+    # Runs in a worker thread
+    compact_path = get_compact_path(path)
+    atomic_write(compact_path, compact.to_bytes())
+    return os.stat(compact_path), cache_manager.measure(path)
+
+async def save_compact(compact: CompactSchedule, path: str) -> None:
+    loop = asyncio.get_event_loop()
+    stat, size = await loop.run_in_executor(None, write_compact, compact, path)
+    compact_cache.put(get_compact_path(path), compact, stat.st_mtime, compact.memory_size())
+    cache_manager.record(path, size, compact.end)
+
+async def load_compact(path: str) -> Optional[CompactSchedule]:
+    # Like load_json, for the compact form of the cached schedule at `path`
+    compact_path = get_compact_path(path)
+    if not compact_cache.needs_recheck(compact_path):
+        return compact_cache.get(compact_path)
+
+    try:
+        stat = await aiofiles.os.stat(compact_path)
+    except FileNotFoundError:
+        compact_cache.invalidate(compact_path)
+        # Caches written before the compact format existed are converted on first use
+        return await rebuild_compact(path)
+
+    cached: Optional[CompactSchedule] = compact_cache.get(compact_path, stat.st_mtime)
+    if cached is not None:
+        return cached
+    async with aiofiles.open(compact_path, mode='rb') as f:
+        raw = await f.read()
+    try:
+        compact = CompactSchedule.from_bytes(raw)
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        # A damaged file or one from another format version is rebuilt from the json
+        logger.warning(f"Unreadable compact schedule {compact_path}, rebuilding it: {e}")
+        return await rebuild_compact(path)
+    compact_cache.put(compact_path, compact, stat.st_mtime, compact.memory_size())
+    return compact
+
+async def rebuild_compact(path: str) -> Optional[CompactSchedule]:
+    data = await load_json(path)
+    if data is None:
+        return None
+    compact = CompactSchedule.from_json(data)
+    await save_compact(compact, path)
+    return compact
+
+async def get_compact(url: str) -> Optional[CompactSchedule]:
+    path = get_cache_path(url)
+    compact = await load_compact(path)
+    if compact is not None:
+        return compact
+    if await get_json(url) is None:
+        return None
+    return await load_compact(path)
 
-# test code
-#if __name__ == '__main__':
-#    json_datas = fetch_jsons_from_csv(env.EVENTS)
-#    save_jsons(json_datas, env.CACHE_DIR)
-#    logger.info("Finished")
+async def collect_cache(urls: list[str]) -> list[str]:
+    # Deletes the cached schedules that `urls` no longer need, and more if the disk budget requires it
+    loop = asyncio.get_event_loop()
+    if not cache_manager.scanned:
+        cache_manager.merge(await loop.run_in_executor(None, cache_manager.scan))
+    referenced = {get_cache_path(url) for url in urls}
+    # A schedule being saved right now is left for the next collection
+    victims = [path for path in cache_manager.select(referenced, time.time()) if not get_save_lock(path).locked()]
+    locks = [get_save_lock(path) for path in victims]
+    for lock in locks:
+        await lock.acquire()
+    try:
+        await loop.run_in_executor(None, cache_manager.remove, victims)
+        for path in victims:
+            cache_manager.evict(path)
+            schedule_cache.invalidate(path)
+            compact_cache.invalidate(get_compact_path(path))
+            _tickers.pop(os.path.relpath(path, env.CACHE_DIR)[:-len(".json")].replace(os.sep, "/"), None)
+    finally:
+        for lock in locks:
+            lock.release()
+    for path in victims:
+        if _save_locks.get(path) is not None and not _save_locks[path].locked():
+            del _save_locks[path]
+    cache_manager.collections += 1
+    logger.info(f"Cache collection evicted {len(victims)} schedules, {cache_manager.stats()}")
+    return victims
@@ -0,0 +1,123 @@
+from loguru import logger
+import bisect
+import functools
+import time
+from typing import Callable, Optional
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_help: dict[str, tuple[str, str]] = {} # name -> (type, help)
+_counters: dict[tuple[str, tuple], float] = {}
+_histograms: dict[tuple[str, tuple], list] = {} # key -> [bucket counts..., overflow, count, sum]
+_buckets: dict[str, tuple[float, ...]] = {}
+_callbacks: dict[str, Callable[[], float]] = {} # gauges and counters kept by other modules
+_runner: Optional[web.AppRunner] = None
+
+def _key(name: str, labels: dict) -> tuple[str, tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def describe(name: str, metric_type: str, help_text: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+    _help[name] = (metric_type, help_text)
+    if metric_type == "histogram":
+        _buckets[name] = buckets
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels) -> None:
+    buckets = _buckets.get(name, DEFAULT_BUCKETS)
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = [0] * (len(buckets) + 3)
+    histogram[bisect.bisect_left(buckets, value)] += 1
+    histogram[-2] += 1
+    histogram[-1] += value
+
+def gauge(name: str, help_text: str, func: Callable[[], float]) -> None:
+    # The value is read from `func` every time the metrics are scraped
+    describe(name, "gauge", help_text)
+    _callbacks[name] = func
+
+def counter(name: str, help_text: str, func: Callable[[], float]) -> None:
+    # Like gauge, for a running total that only goes up
+    describe(name, "counter", help_text)
+    _callbacks[name] = func
+
+def read_stat(stats: Callable[[], dict], key: str) -> float:
+    # For gauges and counters over one entry of a stats() dict, with functools.partial
+    return stats()[key]
+
+def timed(name: str, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+def _format_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def render() -> str:
+    lines = []
+    names = sorted({name for name, _ in _counters} | {name for name, _ in _histograms} | set(_callbacks))
+    for name in names:
+        metric_type, help_text = _help.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if name in _callbacks:
+            try:
+                lines.append(f"{name} {float(_callbacks[name]())}")
+            except Exception as e:
+                logger.warning(f"Failed to read {metric_type} {name}: {e}")
+            continue
+        for (key_name, labels), value in sorted(_counters.items()):
+            if key_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (key_name, labels), histogram in sorted(_histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(_buckets.get(name, DEFAULT_BUCKETS), histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', str(bound)))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]}")
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", headers={"Cache-Control": "no-store"})
+
+async def start_server(host: str, port: int) -> None:
+    global _runner
+    if _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    try:
+        await web.TCPSite(_runner, host, port).start()
+    except OSError:
+        await _runner.cleanup()
+        _runner = None
+        raise
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+async def stop_server() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
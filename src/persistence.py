@@ -0,0 +1,75 @@
+from loguru import logger
+import asyncio
+import os
+import tempfile
+from typing import Any, Callable, Optional
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    # Readers and crashes see either the old file or the new one, never a partial write
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+async def atomic_write_async(path: str, data: bytes) -> None:
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, atomic_write, path, data)
+
+
+class WriteCoalescer:
+    # Every change requested within `window` seconds is persisted by one atomic write of `path`.
+    # `snapshot` runs on the event loop and must copy the state; `encode` turns that copy into
+    # bytes in a worker thread.
+    def __init__(self, path: str, snapshot: Callable[[], Any], encode: Callable[[Any], bytes], window: float):
+        self.path = path
+        self.snapshot = snapshot
+        self.encode = encode
+        self.window = window # seconds
+        self.requests = 0
+        self.writes = 0
+        self._pending: Optional[asyncio.Future] = None
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+
+    async def request(self) -> None:
+        # Returns once a write that includes the caller's changes is on disk
+        self.requests += 1
+        if self._pending is None:
+            self._pending = asyncio.get_event_loop().create_future()
+            task = asyncio.ensure_future(self._flush_later(self._pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        await asyncio.shield(self._pending)
+
+    async def _flush_later(self, future: asyncio.Future) -> None:
+        await asyncio.sleep(self.window)
+        async with self._lock:
+            # Changes requested from here on go into the next write
+            if self._pending is future:
+                self._pending = None
+            try:
+                await self._write()
+            except Exception as e:
+                logger.error(f"Failed to write {self.path}: {e}")
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+
+    async def _write(self) -> None:
+        state = self.snapshot()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, lambda: atomic_write(self.path, self.encode(state)))
+        self.writes += 1
+        logger.debug(f"Wrote {self.path} ({self.requests} changes requested, {self.writes} writes)")
@@ -0,0 +1,83 @@
+from loguru import logger
+import collections
+import time
+from typing import Optional
+
+from src.compact_schedule import CompactSchedule
+
+
+class RefreshPlanner:
+    def __init__(self, live_interval: float, max_interval: float, ended_grace: float, budget_per_hour: int):
+        self.live_interval = live_interval # seconds
+        self.max_interval = max_interval # seconds
+        self.ended_grace = ended_grace # seconds
+        self.budget_per_hour = budget_per_hour
+        self.next_due: dict[str, tuple[float, float]] = {} # schedule path -> (interval, due)
+        self.attempts: dict[str, float] = {} # schedule path -> last request time
+        self.finished: set[str] = set()
+        self.requests: collections.deque[float] = collections.deque()
+        self.deferred = 0
+
+    def interval(self, schedule: Optional[CompactSchedule], now: float) -> Optional[float]:
+        # None means the schedule does not need refreshing anymore
+        if schedule is None or schedule.start is None:
+            return self.max_interval
+        end = schedule.end if schedule.end is not None else schedule.start
+        if end + self.ended_grace < now:
+            return None
+        until_start = schedule.start - now
+        if until_start <= self.live_interval * 12:
+            return self.live_interval
+        # The further away the event, the less often it changes in a way that matters
+        return min(self.max_interval, max(self.live_interval, until_start / 10))
+
+    def plan(self, path: str, schedule: Optional[CompactSchedule], checked_at: float, now: float) -> Optional[float]:
+        interval = self.interval(schedule, now)
+        if interval is None:
+            self.next_due.pop(path, None)
+            self.finished.add(path)
+            return None
+        last = max(checked_at, self.attempts.get(path, 0))
+        if not last:
+            # Never fetched: ahead of everything else
+            self.next_due[path] = (0, now)
+            return now
+        self.next_due[path] = (interval, last + interval)
+        return last + interval
+
+    def is_planned(self, path: str) -> bool:
+        return path in self.next_due or path in self.finished
+
+    def invalidate(self, path: str) -> None:
+        self.next_due.pop(path, None)
+        self.finished.discard(path)
+
+    def remaining(self, now: float) -> int:
+        while self.requests and self.requests[0] <= now - 3600:
+            self.requests.popleft()
+        return max(0, self.budget_per_hour - len(self.requests))
+
+    def select(self, paths: list[str], now: float) -> list[str]:
+        # Shorter intervals first, so live events keep their freshness when the budget runs low
+        due = [path for path in paths if path in self.next_due and self.next_due[path][1] <= now]
+        due.sort(key=lambda path: self.next_due[path])
+        selected = due[:self.remaining(now)]
+        if len(selected) < len(due):
+            self.deferred += len(due) - len(selected)
+            logger.warning(f"Refresh budget exhausted: deferred {len(due) - len(selected)} of {len(due)} due schedules")
+        for path in selected:
+            self.requests.append(now)
+            self.attempts[path] = now
+            self.invalidate(path)
+        return selected
+
+    def forget(self, keep: set[str]) -> None:
+        for path in [path for path in self.attempts if path not in keep]:
+            del self.attempts[path]
+        for path in [path for path in self.next_due if path not in keep]:
+            del self.next_due[path]
+        self.finished &= keep
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {"planned": len(self.next_due), "finished": len(self.finished), "budget_remaining": self.remaining(now), "deferred": self.deferred}
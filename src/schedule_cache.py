@@ -0,0 +1,80 @@
+from loguru import logger
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+def estimate_size(value: Any) -> int:
+    # Bytes the object takes in memory with everything it holds, for parsed JSON values.
+    # Strings and numbers shared between objects are counted each time.
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+
+class ScheduleCache:
+    def __init__(self, max_bytes: int, recheck_interval: float):
+        self.max_bytes = max_bytes # estimated memory of the cached objects
+        self.recheck_interval = recheck_interval # seconds between mtime checks of a cached entry
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def needs_recheck(self, path: str) -> bool:
+        entry = self.entries.get(path)
+        return entry is None or time.monotonic() - entry["checked"] >= self.recheck_interval
+
+    def get(self, path: str, mtime: Optional[float] = None) -> Optional[Any]:
+        entry = self.entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return None
+        if mtime is not None:
+            if mtime != entry["mtime"]:
+                self.invalidate(path)
+                self.misses += 1
+                return None
+            entry["checked"] = time.monotonic()
+        self.entries.move_to_end(path)
+        self.hits += 1
+        return entry["data"]
+
+    def put(self, path: str, data: Any, mtime: float, size: int) -> None:
+        # `size` is the estimated memory of `data`, not the size of its file
+        self.invalidate(path)
+        if size > self.max_bytes:
+            logger.debug(f"Schedule too large to cache: {path} ({size} bytes in memory)")
+            return
+        self.entries[path] = {"data": data, "mtime": mtime, "size": size, "checked": time.monotonic()}
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted["size"]
+            self.evictions += 1
+
+    def invalidate(self, path: str) -> None:
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry["size"]
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
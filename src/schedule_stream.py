@@ -0,0 +1,142 @@
+import codecs
+import json
+import re
+from typing import Optional
+
+# The only parts of a Horaro schedule export the bot reads
+SCHEDULE_FIELDS = ("id", "name", "slug", "timezone", "start", "start_t", "url", "description", "updated", "setup_t")
+ITEM_FIELDS = ("scheduled", "scheduled_t", "length_t", "data")
+
+HEAD, ITEMS, TAIL = range(3)
+STRUCTURE = re.compile(r'[{}\[\]":]')
+STRING_END = re.compile(r'["\\]')
+ITEM_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def project_item(item: dict) -> dict:
+    return {key: item[key] for key in ITEM_FIELDS if key in item}
+
+def project_schedule(json_data: dict, items: Optional[list] = None) -> dict:
+    schedule = json_data.get("schedule") or {}
+    projected = {key: schedule[key] for key in SCHEDULE_FIELDS if key in schedule}
+    projected["items"] = items if items is not None else [project_item(item) for item in schedule.get("items") or []]
+    return {"schedule": projected}
+
+
+class ScheduleStreamParser:
+    # Parses a schedule export fed in chunks. Everything around `schedule.items` is small and
+    # parsed once at the end; each item is decoded as soon as it is complete, projected to
+    # ITEM_FIELDS and its text dropped, so the whole document is never held at once.
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self.phase = HEAD
+        self.head: list[str] = []
+        self.tail: list[str] = []
+        self.items: list[dict] = []
+        self.buffer = ""
+        # Scanner state for the head
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.string_start = 0
+        self.last_string = ""
+        self.keys: dict[int, str] = {}
+
+    def feed(self, chunk: bytes) -> None:
+        self.buffer += self._text.decode(chunk)
+        self._advance(final=False)
+
+    def close(self) -> dict:
+        self.buffer += self._text.decode(b"", final=True)
+        self._advance(final=True)
+        if self.phase == ITEMS:
+            raise ValueError("Unterminated items array in schedule")
+        if self.phase == HEAD:
+            return project_schedule(json.loads("".join(self.head) + self.buffer))
+        return project_schedule(json.loads("".join(self.head) + "]" + "".join(self.tail)), self.items)
+
+    def _advance(self, final: bool) -> None:
+        if self.phase == HEAD:
+            self._scan_head()
+        if self.phase == ITEMS:
+            self._read_items(final)
+        if self.phase == TAIL:
+            self.tail.append(self.buffer)
+            self.buffer = ""
+
+    def _scan_head(self) -> None:
+        buffer = self.buffer
+        pos = self.pos
+        while True:
+            if self.in_string:
+                match = STRING_END.search(buffer, pos)
+                if match is None:
+                    break
+                if match.group() == "\\":
+                    if match.end() >= len(buffer):
+                        pos = match.start() # the escaped character has not arrived yet
+                        break
+                    pos = match.end() + 1
+                    continue
+                self.in_string = False
+                self.last_string = buffer[self.string_start:match.start()]
+                pos = match.end()
+                continue
+
+            match = STRUCTURE.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                self.in_string = True
+                self.string_start = pos
+            elif char == ":":
+                self.keys[self.depth] = self.last_string
+            elif char in "{[":
+                if char == "[" and self.depth == 2 and self.keys.get(1) == "schedule" and self.keys.get(2) == "items":
+                    self.head.append(buffer[:pos])
+                    self.buffer = buffer[pos:]
+                    self.phase = ITEMS
+                    return
+                self.depth += 1
+                self.keys.pop(self.depth, None)
+            else:
+                self.keys.pop(self.depth, None)
+                self.depth -= 1
+        # Scanned text is set aside, except an unfinished string that may still turn out to be a key
+        cut = min(pos, self.string_start) if self.in_string else pos
+        self.head.append(buffer[:cut])
+        self.buffer = buffer[cut:]
+        if self.in_string:
+            self.string_start -= cut
+        self.pos = pos - cut
+
+    def _read_items(self, final: bool) -> None:
+        buffer = self.buffer
+        pos = 0
+        while True:
+            pos = ITEM_SEPARATOR.match(buffer, pos).end() # type: ignore
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                self.buffer = buffer[pos + 1:]
+                self.phase = TAIL
+                return
+            try:
+                item, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break # the item continues in the next chunk
+            self.items.append(project_item(item))
+            pos = end
+        self.buffer = buffer[pos:]
+
+
+def parse_schedule(content: str) -> dict:
+    parser = ScheduleStreamParser()
+    parser.feed(content.encode("utf-8"))
+    return parser.close()
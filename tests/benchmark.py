@@ -0,0 +1,306 @@
+from loguru import logger
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import time
+from aiohttp import web
+
+WORK_DIR = "dev/benchmark"
+OUTPUT = "dev/benchmark.json"
+
+# src.env reads these at import time, so they have to be set first
+os.environ.setdefault("CACHE_DIR", f"{WORK_DIR}/cache")
+os.environ.setdefault("EVENTS", f"{WORK_DIR}/events.csv")
+os.environ.setdefault("EVENTS_DB", f"{WORK_DIR}/events.db")
+os.environ.setdefault("NOTIFY_JOURNAL", f"{WORK_DIR}/notifications.journal")
+os.environ.setdefault("FETCH_RATE_PER_HOST", "100000") # the stub server does not need politeness
+os.environ.setdefault("FETCH_BURST_PER_HOST", "100000")
+
+import src.env as env
+import src.events as events
+import src.event_store as event_store
+import src.fetch_json as fetch_json
+import src.dbot.notify as notify
+import src.dbot.commands as commands
+from src.dbot.scheduler import NotificationScheduler
+from src.dbot.notification_index import NotificationIndex
+from src.dbot.journal import NotificationJournal
+from src.dbot.delivery import ChannelDelivery
+from tests.dummy_events import generate_events
+
+
+def generate_schedule(path: str, items: int, start: int, length: int) -> dict:
+    timezone = datetime.timezone.utc
+    schedule_items = []
+    scheduled_t = start
+    for i in range(items):
+        schedule_items.append({
+            "length": f"PT{length // 60}M",
+            "length_t": length,
+            "scheduled": datetime.datetime.fromtimestamp(scheduled_t, tz=timezone).isoformat(),
+            "scheduled_t": scheduled_t,
+            "data": [f"Game {i}", f"Runner {i}", "Any%"],
+            "options": None,
+        })
+        scheduled_t += length
+    return {
+        "meta": {"exported": datetime.datetime.now(tz=timezone).isoformat()},
+        "schedule": {
+            "name": path.replace("/", " "),
+            "slug": path.split("/")[-1],
+            "timezone": "UTC",
+            "start": datetime.datetime.fromtimestamp(start, tz=timezone).isoformat(),
+            "start_t": start,
+            "description": "Synthetic schedule",
+            "url": f"/{path}",
+            "columns": ["Game", "Runner", "Category"],
+            "items": schedule_items,
+        },
+    }
+
+
+class StubHoraro:
+    def __init__(self, schedules: dict[str, dict], missing: set[str], changing: set[str], latency: float):
+        self.schedules = schedules
+        self.bodies = {path: json.dumps(data).encode("utf-8") for path, data in schedules.items()}
+        self.etags = {path: f'"{hashlib.sha1(body).hexdigest()}"' for path, body in self.bodies.items()}
+        self.missing = missing
+        self.changing = changing # answer every request with a new ETag, so never 304
+        self.versions: dict[str, int] = {}
+        self.latency = latency # seconds
+        self.statuses: dict[int, int] = {}
+        self.runner = None
+        self.base_url = ""
+
+    def ticker(self, path: str) -> dict:
+        schedule = self.schedules[path]["schedule"]
+        items = schedule["items"]
+        now = time.time()
+        index = next((i for i, item in enumerate(items) if item["scheduled_t"] + item["length_t"] > now), len(items))
+        current = index if index < len(items) and items[index]["scheduled_t"] <= now else None
+        upcoming = index + 1 if current is not None else index
+        return {"data": {
+            "schedule": {k: v for k, v in schedule.items() if k != "items"},
+            "ticker": {
+                "previous": items[index - 1] if index > 0 else None,
+                "current": items[current] if current is not None else None,
+                "next": items[upcoming] if upcoming < len(items) else None,
+            },
+        }}
+
+    def etag(self, path: str) -> str:
+        if path in self.changing:
+            return f'"{self.etags[path][1:-1]}-{self.versions.get(path, 0)}"'
+        return self.etags[path]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        path = request.path.lstrip("/").removesuffix(".json")
+        if path.startswith("-/api/v1/events/") and path.endswith("/ticker"):
+            # /-/api/v1/events/{event}/schedules/{schedule}/ticker
+            parts = path.split("/")
+            path = f"{parts[4]}/{parts[6]}"
+            if path in self.missing or path not in self.schedules:
+                response = web.Response(status=404)
+            else:
+                response = web.json_response(self.ticker(path))
+        elif path in self.missing or path not in self.bodies:
+            response = web.Response(status=404)
+        elif path not in self.changing and request.headers.get("If-None-Match") == self.etags[path]:
+            response = web.Response(status=304, headers={"ETag": self.etags[path]})
+        else:
+            if path in self.changing:
+                self.versions[path] = self.versions.get(path, 0) + 1
+            response = web.Response(body=self.bodies[path], content_type="application/json", headers={"ETag": self.etag(path)})
+        self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+        return response
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1] # type: ignore
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+async def reset_state():
+    # Fresh registry, caches, queue and journal so each size starts cold
+    await notify.journal.close()
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    os.makedirs(WORK_DIR, exist_ok=True)
+    events.registry = None
+    events.store = event_store.create_store()
+    fetch_json.schedule_cache.clear()
+    fetch_json.compact_cache.clear()
+    fetch_json._not_found.clear()
+    fetch_json._tickers.clear()
+    notify.sent_notifications = NotificationIndex()
+    notify.event_queue = NotificationScheduler(notify.deliver_notifications)
+    notify.journal = NotificationJournal(env.NOTIFY_JOURNAL, env.NOTIFY_JOURNAL_COMPACT, env.PERSIST_WINDOW)
+
+async def timed(coro) -> float:
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+async def mean_time(func, args: list, samples: int) -> float:
+    durations = []
+    for arg in random.sample(args, min(samples, len(args))):
+        durations.append(await timed(func(arg)))
+    return statistics.fmean(durations) if durations else 0.0
+
+async def run_size(registrations: int, args, stub: StubHoraro, paths: list[str], guilds: list[int]) -> dict:
+    await reset_state()
+    urls = [f"{stub.base_url}/{path}" for path in paths]
+    generate_events(registrations, urls=urls, servers=guilds, path=env.EVENTS)
+    stub.statuses.clear()
+
+    timings = {}
+    timings["load_events"] = await timed(events.load_events())
+    rows = await events.get_event_rows()
+    registered_urls = [row["url"] for row in rows]
+
+    timings["fetch_jsons"] = await timed(fetch_json.fetch_jsons(registered_urls))
+    timings["refresh_cold"] = await timed(fetch_json.update_jsons(registered_urls))
+    timings["refresh_warm"] = await timed(fetch_json.update_jsons(registered_urls))
+
+    notify.sent_notifications = NotificationIndex()
+    notify.event_queue = NotificationScheduler(notify.deliver_notifications)
+    timings["schedule_notifications"] = await timed(notify.schedule_notifications())
+    queued = len(notify.event_queue)
+    timings["schedule_notifications_repeat"] = await timed(notify.schedule_notifications())
+
+    timings["get_now_program"] = await mean_time(commands.get_now_embeds, guilds, args.samples)
+    timings["get_events_server"] = await mean_time(events.get_events_server, guilds, args.samples)
+    timings["get_events_url"] = await mean_time(events.get_events_url, registered_urls, args.samples)
+    timings["get_events_multiple"] = await mean_time(
+        lambda row: events.get_events_multiple(url=row["url"], server=row["server"]), rows, args.samples
+    )
+
+    result = {
+        "registrations": registrations,
+        "timings": timings, # seconds
+        "counts": {
+            "schedules": len(paths),
+            "guilds": len(guilds),
+            "queued_notifications": queued,
+            "http_statuses": dict(stub.statuses),
+        },
+    }
+    logger.info(f"{registrations} registrations: " + ", ".join(f"{name}={value * 1000:.2f}ms" for name, value in timings.items()))
+    return result
+
+async def check_channel_merge() -> dict:
+    # Two schedules with programs at the same time in one channel must be announced in one message
+    await reset_state()
+    now = int(time.time())
+    paths = ["merge/a", "merge/b"]
+    for path in paths:
+        await fetch_json.save_json(generate_schedule(path, 3, now + 3600, 1800), env.CACHE_DIR)
+    await events.load_events()
+    for path in paths:
+        await events.add_event(f"https://horaro.org/{path}", 10, 1, 1)
+    await notify.schedule_notifications(fetch_missing=False)
+
+    first = min(due for due, _, _ in notify.event_queue.items())
+    due = [payload for due, _, payload in notify.event_queue.items() if due == first]
+    messages = []
+    async def capture(batch):
+        messages.append(batch)
+    delivery = notify.delivery
+    notify.delivery = ChannelDelivery(capture, notify.embed_length, 0.01, 1000, 1000)
+    try:
+        await notify.deliver_notifications(due)
+        while notify.delivery.flushers:
+            await asyncio.sleep(0.01)
+    finally:
+        notify.delivery = delivery
+
+    passed = len(due) == len(paths) and len(messages) == 1
+    result = {"passed": passed, "due_together": len(due), "messages": len(messages), "embeds": [len(batch) for batch in messages]}
+    if not passed:
+        logger.error(f"Channel merge check failed: {result}")
+    else:
+        logger.info(f"Channel merge check: {result}")
+    return result
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    now = int(time.time())
+    paths = [f"bench/schedule{i}" for i in range(args.schedules)]
+    # Starts spread around now, so some schedules are live, some upcoming and some over
+    schedules = {
+        path: generate_schedule(path, args.items, now + random.randint(-args.spread, args.spread) * 3600, args.length * 60)
+        for path in paths
+    }
+    missing = set(random.sample(paths, int(len(paths) * args.missing)))
+    guilds = [random.randint(100000000000000000, 999999999999999999) for _ in range(args.guilds)]
+
+    # Drawn after the schedules, 404s and guilds, so those stay the same with any --changing
+    served = [path for path in paths if path not in missing]
+    changing = set(random.sample(served, min(len(served), int(len(paths) * args.changing))))
+    stub = StubHoraro(schedules, missing, changing, args.latency / 1000)
+    await stub.start()
+    try:
+        checks = {"channel_merge": await check_channel_merge()}
+        results = [await run_size(size, args, stub, paths, guilds) for size in args.sizes]
+    finally:
+        await stub.stop()
+        await fetch_json.close_session()
+        await notify.journal.close()
+
+    return {
+        "meta": {
+            "created": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "checks": checks,
+        "results": results,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark against a local Horaro stub server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="registration counts to run")
+    parser.add_argument("--guilds", type=int, default=500)
+    parser.add_argument("--schedules", type=int, default=200, help="distinct Horaro schedules")
+    parser.add_argument("--items", type=int, default=100, help="items per schedule")
+    parser.add_argument("--length", type=int, default=30, help="item length in minutes")
+    parser.add_argument("--spread", type=int, default=168, help="schedule starts are within +/- this many hours of now")
+    parser.add_argument("--latency", type=float, default=20, help="stub response latency in milliseconds")
+    parser.add_argument("--missing", type=float, default=0.05, help="fraction of schedules answering 404")
+    parser.add_argument("--changing", type=float, default=0.0, help="fraction of schedules that change on every request instead of answering 304")
+    parser.add_argument("--samples", type=int, default=200, help="lookups averaged for the per-call timings")
+    parser.add_argument("--seed", type=int, default=58)
+    parser.add_argument("--output", default=OUTPUT)
+    return parser.parse_args(argv)
+
+# python -m tests.benchmark --sizes 1000 10000
+if __name__ == '__main__':
+    args = parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    report = asyncio.run(run(args))
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    logger.info(f"Wrote {args.output}")
+    # A failed check fails the run, so it can gate a deploy
+    if not all(check["passed"] for check in report["checks"].values()):
+        sys.exit(1)
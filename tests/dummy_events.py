@@ -2,15 +2,23 @@ from loguru import logger
 import pandas as pd
 import os
 import random
+from typing import Optional
 from faker import Faker
 
 EVENTS = "dev/events.csv"
 fake = Faker()
 
-def generate_events(n: int):
-    urls = [f"{fake.url()}{fake.slug()}/{fake.slug()}" for _ in range(n)]
+def generate_events(n: int, urls: Optional[list[str]] = None, servers: Optional[list[int]] = None, path: str = EVENTS):
+    # `urls` / `servers` make the rows pick from a fixed set of schedules / guilds instead of random ones
+    if urls is None:
+        urls = [f"{fake.url()}{fake.slug()}/{fake.slug()}" for _ in range(n)]
+    else:
+        urls = [random.choice(urls) for _ in range(n)]
     notices = [random.randint(1, 100) for _ in range(n)]
-    servers = [random.randint(100000000000000000, 999999999999999999) for _ in range(n)]
+    if servers is None:
+        servers = [random.randint(100000000000000000, 999999999999999999) for _ in range(n)]
+    else:
+        servers = [random.choice(servers) for _ in range(n)]
     channels = [random.randint(100000000000000000, 999999999999999999) for _ in range(n)]
 
     df = pd.DataFrame({
@@ -19,16 +27,17 @@ def generate_events(n: int):
         "server": servers,
         "channel": channels
     })
-    if os.path.exists(EVENTS):
-        with open(EVENTS, 'r', encoding='utf-8') as f:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
             has_header = f.readline().strip() != ''
 
         if has_header:
-            df.to_csv(EVENTS, mode='a', header=False, index=False)
+            df.to_csv(path, mode='a', header=False, index=False)
         else:
-            df.to_csv(EVENTS, index=False)
+            df.to_csv(path, index=False)
     else:
-        df.to_csv(EVENTS, index=False)
+        df.to_csv(path, index=False)
     logger.info(f"Generated {n} events")
 
 # test code